@@ -0,0 +1,552 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import signal
+import socket
+import asyncio
+import hashlib
+import argparse
+import platform
+import resource
+import tempfile
+import threading
+import subprocess
+import collections
+from cryptography.fernet import Fernet
+
+# Run from the project folder so the server's storage folders land in a scratch directory
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from code import FileSharingServer, AsyncFileSharingClient
+
+MB = 1024 * 1024
+GB = 1024 * MB
+STORAGE_PATHS = ("uploads", "encrypted", "versions", "blocks", "manifests", "metadata.db", "metadata.db-wal", "journal.log")
+DEFAULT_RESULTS_FILE = "bench_results.json"
+REGRESSION_THRESHOLD = 0.1  # Flag operations that got 10% slower
+STRESS_HOT_FILES = 4  # Files every stress client reads and replaces
+STRESS_OWN_FILES = 16  # Files only one client touches
+STRESS_HOT_SHARE = 0.5  # Share of operations on the hot files
+STRESS_FILE_KB = 64
+
+
+def io_counters():
+    # Bytes passed to read/write system calls by this process (Linux only)
+    try:
+        with open("/proc/self/io") as file:
+            counters = dict(line.split(": ") for line in file.read().splitlines())
+        return int(counters["rchar"]), int(counters["wchar"])
+    except OSError:
+        return None
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / MB if sys.platform == "darwin" else peak / 1024
+
+
+def disk_usage(paths=STORAGE_PATHS):
+    # Bytes stored under the server's folders
+    total = 0
+    for path in paths:
+        if os.path.isfile(path):
+            total += os.path.getsize(path)
+        for folder, _, files in os.walk(path):
+            total += sum(os.path.getsize(os.path.join(folder, name)) for name in files)
+    return total
+
+
+def percentile(values, fraction):
+    # Nearest-rank percentile
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))] if values else 0.0
+
+
+def make_source(path, size, seed=0, text=False):
+    # Write a reproducible file of random bytes, or of CSV-like text lines
+    rng = random.Random(seed)
+    with open(path, "wb") as file:
+        written = 0
+        while written < size:
+            if text:
+                block = b"".join(b"%d,user%d,%d,status=%s\n" % (rng.randrange(10 ** 9), rng.randrange(1000), rng.randrange(10 ** 6), rng.choice((b"ok", b"retry", b"error"))) for _ in range(4096))
+            else:
+                block = rng.randbytes(MB)
+            block = block[:size - written]
+            file.write(block)
+            written += len(block)
+    return path
+
+
+class Recorder:
+    def __init__(self):
+        # Latency samples and bytes moved per operation
+        self.operations = {}
+
+    def measure(self, operation, size, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        elapsed = time.perf_counter() - start
+        samples = self.operations.setdefault(operation, {"latencies": [], "bytes": 0})
+        samples["latencies"].append(elapsed)
+        samples["bytes"] += size
+        return result
+
+    def summary(self):
+        results = {}
+        for operation, samples in self.operations.items():
+            latencies = samples["latencies"]
+            total = sum(latencies)
+            results[operation] = {
+                "count": len(latencies),
+                "bytes": samples["bytes"],
+                "seconds": total,
+                "throughput_mb_s": samples["bytes"] / MB / total if total and samples["bytes"] else None,
+                "p50_ms": percentile(latencies, 0.50) * 1000,
+                "p99_ms": percentile(latencies, 0.99) * 1000,
+            }
+        return results
+
+
+def consume(chunks):
+    # Drain a chunk generator without keeping the data
+    for _ in chunks:
+        pass
+
+
+def bench_files(server, recorder, source_paths):
+    # Run every hot path over a set of source files
+    names = [os.path.basename(path) for path in source_paths]
+    sizes = [os.path.getsize(path) for path in source_paths]
+    for path, size in zip(source_paths, sizes):
+        with open(path, "rb") as file:
+            recorder.measure("hash_file", size, server.hash_file, file)
+    for path, name, size in zip(source_paths, names, sizes):
+        with open(path, "rb") as file:
+            recorder.measure("upload_file", size, server.upload_file, name, file)
+    for name, size in zip(names, sizes):
+        # Downloads are streamed so peak RSS reflects the server, not this harness
+        recorder.measure("download_file", size, lambda: consume(server.iter_download_file(name)))
+    # Whole-file blobs get names of their own; under an uploaded name, decrypt_file would read its blocks instead
+    for path, name, size in zip(source_paths, names, sizes):
+        with open(path, "rb") as file:
+            recorder.measure("encrypt_file", size, server.encrypt_file, name + ".enc", file)
+    for name, size in zip(names, sizes):
+        recorder.measure("decrypt_file", size, lambda: consume(server.iter_decrypt_file(name + ".enc")))
+    for name in names:
+        # Not part of what an upload stores, so kept out of the disk amplification
+        server.release_file_data(name + ".enc", None)
+    for name, size in zip(names, sizes):
+        recorder.measure("create_version", size, server.create_version, name)
+    for _ in range(20):
+        recorder.measure("list_files", 0, server.list_files)
+        recorder.measure("list_files_page", 0, server.list_files, "", 50)
+    return sum(sizes)
+
+
+def bench_versions(server, recorder, source_path, count, seed=0):
+    # Upload and version a file repeatedly with a few small edits between versions
+    rng = random.Random(seed)
+    with open(source_path, "rb") as file:
+        data = bytearray(file.read())
+    name = os.path.basename(source_path)
+    logical = 0
+    for _ in range(count):
+        for _ in range(3):
+            position = rng.randrange(len(data))
+            data[position:position + 64] = rng.randbytes(rng.randrange(1, 128))
+        if server.stat_file(name) is not None:
+            server.remove_file(name)
+        recorder.measure("upload_file", len(data), server.upload_file, name, bytes(data))
+        recorder.measure("create_version", len(data), server.create_version, name)
+        logical += len(data)
+    for version in server.list_versions(name):
+        recorder.measure("get_version", version["size"], lambda: consume(server.get_version(name, version["version_id"])))
+    return logical
+
+
+def run_dataset(dataset, options):
+    # Build one dataset in a scratch folder, benchmark it in this process and print the results as JSON
+    scratch = tempfile.mkdtemp(prefix="fss-bench-")
+    sources = os.path.join(scratch, "sources")
+    os.makedirs(sources)
+    if dataset == "small":
+        paths = [make_source(os.path.join(sources, f"small_{i:06d}.csv"), options["small_size_kb"] * 1024, seed=i, text=True) for i in range(options["small_count"])]
+    elif dataset == "large":
+        paths = [make_source(os.path.join(sources, f"large_{i}.bin"), options["large_size_mb"] * MB, seed=i) for i in range(options["large_count"])]
+    else:
+        paths = [make_source(os.path.join(sources, "similar.csv"), options["version_size_mb"] * MB, text=True)]
+    os.chdir(scratch)
+    start_io = io_counters()
+    # No read cache, so each read decrypts what it reports instead of reusing an earlier loop's blocks
+    server = FileSharingServer(cache_size=0)
+    recorder = Recorder()
+    if dataset == "versions":
+        logical = bench_versions(server, recorder, paths[0], options["version_count"])
+    else:
+        logical = bench_files(server, recorder, paths)
+    end_io = io_counters()
+    result = {
+        "operations": recorder.summary(),
+        "logical_bytes": logical,
+        "disk_bytes": disk_usage(),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    result["disk_amplification"] = result["disk_bytes"] / logical if logical else None
+    if start_io and end_io:
+        result["io_bytes"] = (end_io[0] - start_io[0]) + (end_io[1] - start_io[1])
+    os.chdir(os.path.dirname(scratch))
+    shutil.rmtree(scratch, ignore_errors=True)
+    print(json.dumps(result))
+
+
+def run_suite(datasets, options, output):
+    # Run each dataset in a fresh process so peak RSS and I/O counters don't mix, then save the results
+    results = {
+        "meta": {
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "options": options,
+        },
+        "datasets": {},
+    }
+    for dataset in datasets:
+        command = [sys.executable, os.path.abspath(__file__), "--dataset", dataset, "--options", json.dumps(options)]
+        output_text = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        results["datasets"][dataset] = json.loads(output_text.splitlines()[-1])
+        print_dataset(dataset, results["datasets"][dataset])
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Results saved to {output}")
+    return results
+
+
+def print_dataset(dataset, result):
+    print(f"\n{dataset}: peak RSS {result['peak_rss_mb']:.0f} MB, disk amplification {result['disk_amplification']:.2f}x")
+    for operation, stats in result["operations"].items():
+        throughput = f"{stats['throughput_mb_s']:9.1f} MB/s" if stats["throughput_mb_s"] else " " * 14
+        print(f"  {operation:<16} {throughput}  p50 {stats['p50_ms']:9.2f} ms  p99 {stats['p99_ms']:9.2f} ms  ({stats['count']} calls)")
+
+
+def compare_results(baseline_path, current_path, threshold=REGRESSION_THRESHOLD):
+    # Report per-operation changes between two result files; returns the number of regressions
+    with open(baseline_path) as file:
+        baseline = json.load(file)["datasets"]
+    with open(current_path) as file:
+        current = json.load(file)["datasets"]
+    regressions = 0
+    for dataset in sorted(set(baseline) & set(current)):
+        print(f"\n{dataset}:")
+        for operation in sorted(set(baseline[dataset]["operations"]) & set(current[dataset]["operations"])):
+            before = baseline[dataset]["operations"][operation]["p50_ms"]
+            after = current[dataset]["operations"][operation]["p50_ms"]
+            change = (after - before) / before if before else 0.0
+            regressed = change > threshold
+            regressions += regressed
+            print(f"  {operation:<16} p50 {before:9.2f} -> {after:9.2f} ms ({change:+.0%}){'  REGRESSION' if regressed else ''}")
+        before, after = baseline[dataset]["peak_rss_mb"], current[dataset]["peak_rss_mb"]
+        print(f"  {'peak RSS':<16} {before:9.0f} -> {after:9.0f} MB")
+    return regressions
+
+
+def legacy_upload(source_path):
+    # The original upload path: read the whole file, write the plaintext copy, encrypt it with one Fernet call,
+    # then re-read the copy to hash it and copy it again for create_version
+    for folder in ("uploads", "encrypted", "versions"):
+        os.makedirs(folder, exist_ok=True)
+    cipher = Fernet(Fernet.generate_key())
+    name = os.path.basename(source_path)
+    with open(source_path, "rb") as file:
+        data = file.read()
+    with open(os.path.join("uploads", name), "wb") as file:
+        file.write(data)
+    with open(os.path.join("encrypted", name), "wb") as file:
+        file.write(cipher.encrypt(data))
+    with open(os.path.join("uploads", name), "rb") as file:
+        hash_value = hashlib.sha256(file.read()).hexdigest()
+    shutil.copy(os.path.join("uploads", name), os.path.join("versions", hash_value))
+
+
+def pipeline_upload(source_path):
+    # The single-pass path: one read feeds the hash and the chunk encryption; only ciphertext is written
+    server = FileSharingServer()
+    name = os.path.basename(source_path)
+    with open(source_path, "rb") as file:
+        server.upload_file(name, file)
+    server.create_version(name)
+
+
+UPLOADS = {"before": legacy_upload, "after": pipeline_upload}
+
+
+def run_upload(variant, source_path):
+    # Measure one upload in this (fresh) process and print the result as JSON
+    os.chdir(tempfile.mkdtemp(prefix="fss-bench-"))
+    start_io = io_counters()
+    start = time.perf_counter()
+    UPLOADS[variant](source_path)
+    seconds = time.perf_counter() - start
+    end_io = io_counters()
+    size = os.path.getsize(source_path)
+    result = {
+        "variant": variant,
+        "bytes": size,
+        "seconds": seconds,
+        "seconds_per_gb": seconds * GB / size,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    if start_io and end_io:
+        touched = (end_io[0] - start_io[0]) + (end_io[1] - start_io[1])
+        result["bytes_touched"] = touched
+        result["bytes_touched_per_byte"] = touched / size
+    shutil.rmtree(os.getcwd(), ignore_errors=True)
+    print(json.dumps(result))
+
+
+def compare_uploads(size):
+    # Run the old and new upload paths in separate processes so peak RSS and I/O counters don't mix
+    scratch = tempfile.mkdtemp(prefix="fss-bench-")
+    try:
+        source_path = make_source(os.path.join(scratch, "source.bin"), size)
+        results = []
+        for variant in UPLOADS:
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), "--run", variant, source_path], check=True, capture_output=True, text=True).stdout
+            results.append(json.loads(output))
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+    for result in results:
+        print(f"{result['variant']:>6}: {result['seconds_per_gb']:8.1f} s/GB, "
+              f"{result.get('bytes_touched_per_byte', float('nan')):5.2f} bytes touched per byte, "
+              f"peak RSS {result['peak_rss_mb']:.0f} MB")
+    return results
+
+
+def stress_payload(rng, size):
+    # Random content followed by its own SHA256, so any torn or mixed read is detected without knowing who wrote it
+    body = rng.randbytes(size)
+    return body + hashlib.sha256(body).digest()
+
+
+def payload_valid(data):
+    return len(data) >= 32 and hashlib.sha256(data[:-32]).digest() == data[-32:]
+
+
+def stress_client(client_id, operations, seconds, seed):
+    # Mix downloads, conditional replaces, removes and versions over the shared hot files and this client's own files.
+    # Any exception is counted as an error, since a download racing a replace or remove must still succeed or find nothing
+    rng = random.Random(seed)
+    counts = collections.Counter()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        if rng.random() < STRESS_HOT_SHARE:
+            name = f"hot_{rng.randrange(STRESS_HOT_FILES)}"
+        else:
+            name = f"own_{client_id}_{rng.randrange(STRESS_OWN_FILES)}"
+        choice = rng.random()
+        try:
+            if choice < 0.45:
+                data = operations["download"](name)
+                counts["download"] += 1
+                if data is not None and not payload_valid(data):
+                    counts["corrupt"] += 1
+            elif choice < 0.8:
+                # Replace only what was read; a concurrent writer makes this a conflict instead of a lost update
+                stat = operations["stat"](name)
+                if operations["upload"](name, stress_payload(rng, STRESS_FILE_KB * 1024), stat and stat["sha256"]):
+                    counts["upload"] += 1
+                else:
+                    counts["conflict"] += 1
+            elif choice < 0.9:
+                # Remove and upload again straight away, racing readers and writers of the same name
+                if operations["remove"](name):
+                    counts["remove"] += 1
+                    if operations["upload"](name, stress_payload(rng, STRESS_FILE_KB * 1024), None):
+                        counts["upload"] += 1
+                    else:
+                        counts["conflict"] += 1
+            else:
+                operations["version"](name)
+                counts["version"] += 1
+        except Exception as error:
+            counts["errors"] += 1
+            print(f"client {client_id}: {name}: {error!r}", file=sys.stderr)
+    return counts
+
+
+def local_operations(server):
+    return {
+        "download": server.download_file,
+        "stat": server.stat_file,
+        "upload": lambda name, data, if_match: server.upload_file(name, data, if_match=if_match),
+        "version": server.create_version,
+        "remove": server.remove_file,
+    }
+
+
+def remote_operations(host, port, scratch):
+    # Blocking wrappers around one connection to a NetworkServer
+    loop = asyncio.new_event_loop()
+    client = loop.run_until_complete(AsyncFileSharingClient(host, port).connect())
+
+    def download(name):
+        path = loop.run_until_complete(client.download_whole_file(name, scratch))
+        if path is None:
+            return None
+        with open(path, "rb") as file:
+            return file.read()
+
+    def upload(name, data, if_match):
+        path = os.path.join(scratch, name)
+        with open(path, "wb") as file:
+            file.write(data)
+        return loop.run_until_complete(client.upload_file(path, if_match))
+
+    return {
+        "download": download,
+        "stat": lambda name: loop.run_until_complete(client.stat_file(name)),
+        "upload": upload,
+        "version": lambda name: loop.run_until_complete(client.create_version(name)),
+        "remove": lambda name: loop.run_until_complete(client.remove_file(name)),
+    }
+
+
+def verify_storage(server):
+    # Check every file and version against its own hash, and every block reference count against the manifests
+    problems = []
+    counts = collections.Counter()
+    for name in server.list_files():
+        if not payload_valid(server.download_file(name)):
+            problems.append(f"file {name} is corrupt")
+        counts.update(block_hash for block_hash, _ in server.load_manifest(server.manifest_path(name))["chunks"])
+    for name in server.index.versioned():
+        for version in server.index.list_versions(name):
+            if not payload_valid(b"".join(server.get_version(name, version["version_id"]))):
+                problems.append(f"version {version['version_id']} of {name} is corrupt")
+            counts.update(block_hash for block_hash, _ in server.load_version_manifest(name, version["version_id"])["chunks"])
+    refs = dict(server.blocks.db.execute("SELECT hash, refs FROM blocks"))
+    if refs != dict(counts):
+        problems.append(f"{sum(refs[block_hash] != counts[block_hash] for block_hash in refs.keys() | counts.keys())} blocks have wrong reference counts")
+    return problems
+
+
+def stress_threads(clients, seconds):
+    # Run clients as threads against one in-process server
+    scratch = tempfile.mkdtemp(prefix="fss-stress-")
+    os.chdir(scratch)
+    server = FileSharingServer()
+    results = [None] * clients
+    threads = [threading.Thread(target=lambda i: results.__setitem__(i, stress_client(i, local_operations(server), seconds, i)), args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    problems = verify_storage(server)
+    server.close()
+    os.chdir(os.path.dirname(scratch))
+    shutil.rmtree(scratch, ignore_errors=True)
+    return sum(results, collections.Counter()), problems
+
+
+def stress_processes(clients, seconds):
+    # Run clients as separate processes talking to a network server, then check the storage it leaves behind
+    scratch = tempfile.mkdtemp(prefix="fss-stress-")
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    code_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "code.py")
+    server_process = subprocess.Popen([sys.executable, code_path, "serve", "127.0.0.1", str(port)], cwd=scratch, stdout=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port)).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.05)
+        workers = [subprocess.Popen([sys.executable, os.path.abspath(__file__), "--stress-worker", json.dumps({"client_id": i, "port": port, "seconds": seconds})],
+                                    stdout=subprocess.PIPE, text=True) for i in range(clients)]
+        totals = collections.Counter()
+        for worker in workers:
+            totals.update(json.loads(worker.communicate()[0].splitlines()[-1]))
+    finally:
+        # The server closes its journal on interrupt, like Ctrl-C
+        server_process.send_signal(signal.SIGINT)
+        server_process.wait()
+    os.chdir(scratch)
+    server = FileSharingServer()
+    problems = verify_storage(server)
+    server.close()
+    os.chdir(os.path.dirname(scratch))
+    shutil.rmtree(scratch, ignore_errors=True)
+    return totals, problems
+
+
+def run_stress_worker(options):
+    # One stress client process; prints its operation counts as JSON
+    scratch = tempfile.mkdtemp(prefix="fss-stress-client-")
+    counts = stress_client(options["client_id"], remote_operations("127.0.0.1", options["port"], scratch), options["seconds"], options["client_id"])
+    shutil.rmtree(scratch, ignore_errors=True)
+    print(json.dumps(counts))
+
+
+def run_stress(seconds, levels):
+    # Measure throughput as clients are added, first as threads sharing a server, then as processes over TCP
+    results = []
+    for mode, run in (("threads", stress_threads), ("processes", stress_processes)):
+        for clients in levels:
+            counts, problems = run(clients, seconds)
+            operations = counts["download"] + counts["upload"] + counts["conflict"] + counts["remove"] + counts["version"]
+            results.append({"mode": mode, "clients": clients, "ops_per_s": operations / seconds, "counts": dict(counts), "problems": problems})
+            print(f"{mode:>9} x{clients:<3} {operations / seconds:8.1f} ops/s  {counts['conflict']:5d} conflicts  {counts['remove']:5d} removes  "
+                  f"{counts['corrupt']} corrupt reads  {counts['errors']} errors  {len(problems)} storage problems")
+            for problem in problems:
+                print(f"    {problem}")
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the file sharing server's hot paths.")
+    parser.add_argument("--datasets", default="small,large,versions", help="comma-separated datasets to run: small, large, versions")
+    parser.add_argument("--small-count", type=int, default=1000, help="number of small files")
+    parser.add_argument("--small-size-kb", type=int, default=4, help="size of each small file in KiB")
+    parser.add_argument("--large-count", type=int, default=2, help="number of large files")
+    parser.add_argument("--large-size-mb", type=int, default=64, help="size of each large file in MiB (use 2048+ for multi-GB runs)")
+    parser.add_argument("--version-count", type=int, default=20, help="number of versions of the similar file")
+    parser.add_argument("--version-size-mb", type=int, default=8, help="size of the similar file in MiB")
+    parser.add_argument("--output", default=DEFAULT_RESULTS_FILE, help="where to save machine-readable results")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"), help="compare two result files and exit non-zero on regressions")
+    parser.add_argument("--pipeline", type=int, metavar="SIZE_MB", help="compare the original and single-pass upload paths on one file")
+    parser.add_argument("--stress", type=float, metavar="SECONDS", help="run concurrent clients on shared and private files for SECONDS per level and check for corruption")
+    parser.add_argument("--stress-clients", default="1,2,4,8", help="comma-separated client counts for --stress")
+    parser.add_argument("--stress-worker", help=argparse.SUPPRESS)
+    parser.add_argument("--dataset", help=argparse.SUPPRESS)
+    parser.add_argument("--options", help=argparse.SUPPRESS)
+    parser.add_argument("--run", nargs=2, metavar=("VARIANT", "SOURCE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.run:
+        run_upload(*args.run)
+    elif args.dataset:
+        run_dataset(args.dataset, json.loads(args.options))
+    elif args.compare:
+        sys.exit(1 if compare_results(*args.compare) else 0)
+    elif args.pipeline:
+        compare_uploads(args.pipeline * MB)
+    elif args.stress_worker:
+        run_stress_worker(json.loads(args.stress_worker))
+    elif args.stress:
+        results = run_stress(args.stress, [int(clients) for clients in args.stress_clients.split(",")])
+        sys.exit(1 if any(result["problems"] or result["counts"].get("corrupt") or result["counts"].get("errors") for result in results) else 0)
+    else:
+        options = {
+            "small_count": args.small_count,
+            "small_size_kb": args.small_size_kb,
+            "large_count": args.large_count,
+            "large_size_mb": args.large_size_mb,
+            "version_count": args.version_count,
+            "version_size_mb": args.version_size_mb,
+        }
+        run_suite(args.datasets.split(","), options, args.output)
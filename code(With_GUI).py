@@ -1,133 +1,88 @@
 import os
-import shutil
-import hashlib
-from cryptography.fernet import Fernet
+import sys
 from PyQt5 import QtWidgets, QtGui, QtCore
-from PyQt5.QtWidgets import QApplication, QMainWindow, QPushButton, QLabel, QFileDialog, QMessageBox
-
-UPLOADS_FOLDER = "uploads"
-ENCRYPTED_FOLDER = "encrypted"
-KEY_FILE = "key.key"
-VERSIONS_FOLDER = "versions"
-
-
-class FileSharingServer:
-    def __init__(self):
-        if not os.path.exists(UPLOADS_FOLDER):
-            os.makedirs(UPLOADS_FOLDER)
-        if not os.path.exists(ENCRYPTED_FOLDER):
-            os.makedirs(ENCRYPTED_FOLDER)
-        if not os.path.exists(VERSIONS_FOLDER):
-            os.makedirs(VERSIONS_FOLDER)
-        if not os.path.exists(KEY_FILE):
-            key = Fernet.generate_key()
-            with open(KEY_FILE, "wb") as key_file:
-                key_file.write(key)
-        else:
-            with open(KEY_FILE, "rb") as key_file:
-                self.key = key_file.read()
-                self.cipher = Fernet(self.key)
-
-    def encrypt_file(self, file_name, data):
-        encrypted_data = self.cipher.encrypt(data)
-        encrypted_file_path = os.path.join(ENCRYPTED_FOLDER, file_name)
-        with open(encrypted_file_path, "wb") as file:
-            file.write(encrypted_data)
-        return encrypted_file_path
-
-    def decrypt_file(self, file_name):
-        encrypted_file_path = os.path.join(ENCRYPTED_FOLDER, file_name)
-        with open(encrypted_file_path, "rb") as file:
-            encrypted_data = file.read()
-        decrypted_data = self.cipher.decrypt(encrypted_data)
-        return decrypted_data
-
-    def hash_file(self, data):
-        hash_object = hashlib.sha256()
-        hash_object.update(data)
-        return hash_object.hexdigest()
-
-    def upload_file(self, file_name, data, show_encryption_process=False):
-        file_path = os.path.join(UPLOADS_FOLDER, file_name)
-        if os.path.exists(file_path):
-            return None  # File already exists
-        with open(file_path, "wb") as file:
-            file.write(data)
-        if show_encryption_process:
-            print("Starting encryption process...")
-            print("Step 1: Reading file content.")
-            print("Step 2: Encrypting file content.")
-        encrypted_file_path = self.encrypt_file(file_name, data)
-        return file_name
-
-    def download_file(self, file_name):
-        file_path = os.path.join(UPLOADS_FOLDER, file_name)
-        if os.path.exists(file_path):
-            with open(file_path, "rb") as file:
-                return file.read()
-        else:
-            return None
+from PyQt5.QtWidgets import QApplication, QMainWindow, QPushButton, QLabel, QFileDialog, QMessageBox, QListWidget
 
-    def list_files(self):
-        return os.listdir(UPLOADS_FOLDER)
+# The GUI drives the same server as the command line, so both share one storage folder format
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from code import FileSharingServer, PARTIAL_SUFFIX
 
-    def create_version(self, file_name):
-        file_path = os.path.join(UPLOADS_FOLDER, file_name)
-        if os.path.exists(file_path):
-            with open(file_path, "rb") as file:
-                data = file.read()
-            hash_value = self.hash_file(data)
-            version_folder = os.path.join(VERSIONS_FOLDER, file_name)
-            if not os.path.exists(version_folder):
-                os.makedirs(version_folder)
-            version_file_path = os.path.join(version_folder, hash_value)
-            if not os.path.exists(version_file_path):
-                shutil.copy(file_path, version_file_path)
-                return True
-        return False
+TRANSFER_WORKERS = 4  # Transfers running at once; the rest wait in the queue
+PREVIEW_BYTES = 1024  # Ciphertext shown by the "view encrypted" action
+
+
+class TransferCancelled(Exception):
+    pass
+
+
+class ProgressReader:
+    def __init__(self, file, task):
+        # Wrap a binary file so every read reports progress and stops the upload once the task is cancelled
+        self.file = file
+        self.task = task
+        self.done = 0
+
+    def readinto(self, buffer):
+        if self.task.cancelled:
+            raise TransferCancelled
+        size = self.file.readinto(buffer)
+        self.done += size
+        self.task.report(self.done)
+        return size
+
+    def read(self, size=-1):
+        if self.task.cancelled:
+            raise TransferCancelled
+        data = self.file.read(size)
+        self.done += len(data)
+        self.task.report(self.done)
+        return data
 
 
 class FileSharingClient:
     def __init__(self, server):
         self.server = server
 
-    def upload_file(self, file_path):
-        show_encryption_process = QMessageBox.question(None, "Encryption Process", "Do you want to see the encryption process?", QMessageBox.Yes | QMessageBox.No)
-        if show_encryption_process == QMessageBox.Yes:
-            show_encryption_process = True
-        else:
-            show_encryption_process = False
-        
-        if not os.path.exists(file_path):
-            QMessageBox.critical(None, "File Not Found", f"File '{file_path}' not found.")
-            return None
+    def upload_file(self, file_path, task, show_encryption_process=False):
+        # Stream a file to the server; returns the uploaded name, or None if it already exists
         file_name = os.path.basename(file_path)
+        task.total = os.path.getsize(file_path)
         with open(file_path, "rb") as file:
-            data = file.read()
-        uploaded_file_name = self.server.upload_file(file_name, data, show_encryption_process=show_encryption_process)
-        if uploaded_file_name:
-            return uploaded_file_name
-        else:
-            QMessageBox.critical(None, "File Upload Failed", "File already exists on the server.")
-            return None
+            return self.server.upload_file(file_name, ProgressReader(file, task), show_encryption_process=show_encryption_process)
 
-    def download_file(self, file_name, destination_folder):
-        while not os.path.exists(destination_folder):
-            QMessageBox.critical(None, "Folder Not Found", "Destination folder does not exist.")
-            destination_folder = QFileDialog.getExistingDirectory(None, "Select Destination Folder")
-        if file_name:
-            data = self.server.download_file(file_name)
-            if data:
-                file_path = os.path.join(destination_folder, file_name)
-                with open(file_path, "wb") as file:
-                    file.write(data)
-                return file_path
-            else:
-                QMessageBox.critical(None, "File Not Found", f"File '{file_name}' not found on the server.")
-                return None
-        else:
-            QMessageBox.critical(None, "File Name Not Provided", "File name not provided.")
+    def download_file(self, file_name, destination_folder, task):
+        # Stream a file from the server into a partial file that only replaces the destination once complete
+        stat = self.server.stat_file(file_name)
+        chunks = self.server.iter_download_file(file_name)
+        if stat is None or chunks is None:
             return None
+        task.total = stat["size"]
+        file_path = os.path.join(destination_folder, file_name)
+        partial_path = file_path + PARTIAL_SUFFIX
+        try:
+            with open(partial_path, "wb") as file:
+                done = 0
+                for chunk in chunks:
+                    if task.cancelled:
+                        raise TransferCancelled
+                    file.write(chunk)
+                    done += len(chunk)
+                    task.report(done)
+        except BaseException:
+            chunks.close()
+            os.remove(partial_path)
+            raise
+        os.replace(partial_path, file_path)
+        return file_path
+
+    def preview_encrypted(self, file_name, limit=PREVIEW_BYTES):
+        # The first limit bytes of a file's stored ciphertext, without reading the rest
+        preview = b""
+        for blob in self.server.iter_encrypted(file_name):
+            preview += blob[:limit - len(preview)]
+            if len(preview) >= limit:
+                break
+        return preview
 
     def list_files(self):
         return self.server.list_files()
@@ -136,10 +91,53 @@ class FileSharingClient:
         return self.server.create_version(file_name)
 
 
+class TaskSignals(QtCore.QObject):
+    # Signals are emitted from worker threads and delivered on the GUI thread
+    progress = QtCore.pyqtSignal(int, int, int)  # task id, bytes done, bytes total
+    finished = QtCore.pyqtSignal(int, str)
+    failed = QtCore.pyqtSignal(int, str)
+
+
+class Task(QtCore.QRunnable):
+    def __init__(self, task_id, description, function, *args):
+        # Run function(*args, task) on the thread pool; it returns the message shown when it finishes
+        super().__init__()
+        self.task_id = task_id
+        self.description = description
+        self.function = function
+        self.args = args
+        self.signals = TaskSignals()
+        self.cancelled = False
+        self.total = 0
+
+    def report(self, done):
+        self.signals.progress.emit(self.task_id, done, self.total)
+
+    def cancel(self):
+        # Checked by the transfer between reads and writes
+        self.cancelled = True
+
+    def run(self):
+        try:
+            message = self.function(*self.args, self)
+        except TransferCancelled:
+            self.signals.failed.emit(self.task_id, "cancelled")
+        except Exception as error:
+            self.signals.failed.emit(self.task_id, f"failed: {error}")
+        else:
+            self.signals.finished.emit(self.task_id, message)
+
+
 class MainWindow(QMainWindow):
-    def __init__(self):
+    def __init__(self, server):
         super().__init__()
         self.setWindowTitle("File Sharing Application")
+        # One client for the lifetime of the window; transfers run on a bounded thread pool
+        self.client = FileSharingClient(server)
+        self.pool = QtCore.QThreadPool()
+        self.pool.setMaxThreadCount(TRANSFER_WORKERS)
+        self.tasks = {}
+        self.task_ids = iter(range(1, sys.maxsize))
 
         self.choice_label = QLabel("Choose an option:", self)
         self.choice_label.setGeometry(50, 50, 500, 50)
@@ -168,55 +166,112 @@ class MainWindow(QMainWindow):
         self.previous_executions_text.setWordWrap(True)  # Enable word wrap
         self.previous_executions_text.setScaledContents(True)  # Enable scaling
 
+        self.transfers_label = QLabel("Transfers:", self)
+        self.transfers_label.setGeometry(50, 560, 500, 30)
+        self.transfers_label.setStyleSheet("font-size: 16px; font-weight: bold;")
+
+        self.transfers_list = QListWidget(self)
+        self.transfers_list.setGeometry(50, 600, 500, 120)
+        self.transfers_list.setStyleSheet("font-size: 14px;")
+
+        self.cancel_button = QPushButton("Cancel Transfer", self)
+        self.cancel_button.setGeometry(225, 730, 150, 30)
+        self.cancel_button.setStyleSheet("font-size: 14px;")
+        self.cancel_button.clicked.connect(self.cancel_selected)
+
         self.previous_executions = []
 
+    def start_task(self, description, function, *args):
+        # Queue work on the thread pool and show it in the transfers list
+        task = Task(next(self.task_ids), description, function, *args)
+        task.item = QtWidgets.QListWidgetItem(f"{description}: queued")
+        task.item.setData(QtCore.Qt.UserRole, task.task_id)
+        self.transfers_list.addItem(task.item)
+        task.signals.progress.connect(self.show_progress)
+        task.signals.finished.connect(self.finish_task)
+        task.signals.failed.connect(self.fail_task)
+        self.tasks[task.task_id] = task
+        self.pool.start(task)
+
+    def show_progress(self, task_id, done, total):
+        task = self.tasks.get(task_id)
+        if task is not None:
+            percent = f"{done * 100 // total}%" if total else f"{done} bytes"
+            task.item.setText(f"{task.description}: {percent}")
+
+    def finish_task(self, task_id, message):
+        task = self.tasks.pop(task_id)
+        task.item.setText(f"{task.description}: done")
+        self.output_label.setText(message)
+        self.previous_executions.append(message)
+        self.update_previous_executions()
+
+    def fail_task(self, task_id, reason):
+        task = self.tasks.pop(task_id)
+        task.item.setText(f"{task.description}: {reason}")
+        self.previous_executions.append(f"{task.description} {reason}")
+        self.update_previous_executions()
+
+    def cancel_selected(self):
+        item = self.transfers_list.currentItem()
+        if item is not None and item.data(QtCore.Qt.UserRole) in self.tasks:
+            self.tasks[item.data(QtCore.Qt.UserRole)].cancel()
+            item.setText(item.text().rsplit(":", 1)[0] + ": cancelling")
+
+    def upload(self, file_path, show_encryption_process, task):
+        uploaded_file_name = self.client.upload_file(file_path, task, show_encryption_process)
+        if not uploaded_file_name:
+            raise ValueError("file already exists on the server")
+        return f"File uploaded successfully: {uploaded_file_name}"
+
+    def download(self, file_name, destination_folder, task):
+        downloaded_file_path = self.client.download_file(file_name, destination_folder, task)
+        if not downloaded_file_path:
+            raise ValueError(f"file '{file_name}' not found on the server")
+        return f"File downloaded successfully and saved to: {downloaded_file_path}"
+
+    def preview(self, file_name, task):
+        encrypted_data = self.client.preview_encrypted(file_name)
+        if not encrypted_data:
+            raise ValueError(f"file '{file_name}' not found on the server")
+        return f"Encrypted data (first {len(encrypted_data)} bytes of {file_name}): {encrypted_data.hex()}"
+
     def handle_choice(self):
+        # Dialogs run here on the GUI thread; reading, encrypting and writing files run on the thread pool
         user_choice, ok = QtWidgets.QInputDialog.getText(self, 'User Choice', "Enter 'U' to upload a file, 'D' to download a file, 'L' to list files, 'E' to view encrypted file, or 'Q' to quit:")
         if ok:
             self.choice_var = user_choice.strip().upper()
-            client = FileSharingClient(server)
             if self.choice_var == 'U':
-                file_path, _ = QFileDialog.getOpenFileName(self, "Select File to Upload")
-                if file_path:
-                    uploaded_file_name = client.upload_file(file_path)
-                    if uploaded_file_name:
-                        self.output_label.setText(f"File uploaded successfully: {uploaded_file_name}")
-                        self.previous_executions.append(f"Uploaded file: {uploaded_file_name}")
+                file_paths, _ = QFileDialog.getOpenFileNames(self, "Select Files to Upload")
+                if file_paths:
+                    show_encryption_process = QMessageBox.question(self, "Encryption Process", "Do you want to see the encryption process?", QMessageBox.Yes | QMessageBox.No) == QMessageBox.Yes
+                    for file_path in file_paths:
+                        self.start_task(f"Upload {os.path.basename(file_path)}", self.upload, file_path, show_encryption_process)
             elif self.choice_var == 'D':
-                files = client.list_files()
+                files = self.client.list_files()
                 if files:
                     file_name, ok = QtWidgets.QInputDialog.getItem(self, "File Name", "Files on server:", files, 0, False)
                     if ok:
                         destination_folder = QFileDialog.getExistingDirectory(self, "Select Destination Folder")
                         if destination_folder:
-                            downloaded_file_path = client.download_file(file_name, destination_folder)
-                            if downloaded_file_path:
-                                self.output_label.setText(f"File downloaded successfully and saved to: {downloaded_file_path}")
-                                self.previous_executions.append(f"Downloaded file: {file_name}")
+                            self.start_task(f"Download {file_name}", self.download, file_name, destination_folder)
                         else:
                             self.output_label.setText("Destination folder not selected.")
                 else:
                     self.output_label.setText("No files found on the server.")
             elif self.choice_var == 'L':
-                files = client.list_files()
+                files = self.client.list_files()
                 if files:
                     self.output_label.setText("Files on server:\n" + "\n".join(files))
                     self.previous_executions.append("Listed files")
                 else:
                     self.output_label.setText("No files found on the server.")
             elif self.choice_var == 'E':
-                files = client.list_files()
+                files = self.client.list_files()
                 if files:
                     file_name, ok = QtWidgets.QInputDialog.getItem(self, "File Name", "Files on server:", files, 0, False)
                     if ok:
-                        encrypted_file_path = os.path.join(ENCRYPTED_FOLDER, file_name)
-                        if os.path.exists(encrypted_file_path):
-                            with open(encrypted_file_path, "rb") as file:
-                                encrypted_data = file.read()
-                            self.output_label.setText(f"Encrypted data: {encrypted_data}")
-                            self.previous_executions.append(f"Viewed encrypted data of file: {file_name}")
-                        else:
-                            self.output_label.setText(f"File '{file_name}' not found on the server.")
+                        self.start_task(f"View encrypted {file_name}", self.preview, file_name)
                 else:
                     self.output_label.setText("No files found on the server.")
             elif self.choice_var == 'Q':
@@ -228,6 +283,16 @@ class MainWindow(QMainWindow):
                     self.close()
         self.update_previous_executions()
 
+    def closeEvent(self, event):
+        # Stop running transfers and wait for their threads before the window goes away
+        for task in self.tasks.values():
+            task.cancel()
+        self.pool.clear()
+        self.pool.waitForDone()
+        # A clean shutdown lets the next start skip journal recovery
+        self.client.server.close()
+        event.accept()
+
     def update_previous_executions(self):
         self.previous_executions_text.setText("\n".join(self.previous_executions))
         for execution in self.previous_executions:
@@ -237,7 +302,7 @@ class MainWindow(QMainWindow):
 if __name__ == "__main__":
     app = QApplication([])
     server = FileSharingServer()
-    window = MainWindow()
+    window = MainWindow(server)
     window.setGeometry(200, 200, 800, 800)
     window.show()
     app.exec_()
@@ -1,142 +1,2211 @@
+import io
 import os
-import shutil
+import sys
+import json
+import queue
+import socket
+import bisect
+import asyncio
+import base64
+import struct
+import hmac
 import hashlib
-from cryptography.fernet import Fernet
+import sqlite3
+import threading
+import time
+import zlib
+import itertools
+import functools
+import contextlib
+import collections
+import http.server
+import concurrent.futures
+from cryptography.exceptions import InvalidTag
+from cryptography.fernet import Fernet, InvalidToken
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None  # Not on Windows, where the storage folder isn't locked
 
 # Define constant variables for folders and file names
 UPLOADS_FOLDER = "uploads"
 ENCRYPTED_FOLDER = "encrypted"
 KEY_FILE = "key.key"
 VERSIONS_FOLDER = "versions"
+BLOCKS_FOLDER = "blocks"
+MANIFESTS_FOLDER = "manifests"
+BLOCK_INDEX_FILE = "blocks.db"
+MANIFEST_SUFFIX = ".manifest"
+DELTA_SUFFIX = ".delta"
+VERSION_SNAPSHOT_INTERVAL = 8  # Every 8th version of a file is a full manifest, the rest are deltas against the previous one
+METADATA_INDEX_FILE = "metadata.db"
+JOURNAL_FILE = "journal.log"
+JOURNAL_CHECKPOINT_RECORDS = 10000  # Finished operations kept in the journal before it is truncated
+TEMPORARY_SUFFIX = ".tmp"
+LIST_PAGE_SIZE = 50
 
+# Streaming encryption format: a header followed by AES-GCM frames of at most STREAM_CHUNK_SIZE plaintext bytes
+STREAM_MAGIC = b"FSSE"
+STREAM_VERSION = 2
+STREAM_CHUNK_SIZE = 1024 * 1024
+STREAM_PREFIX = struct.Struct(">4sB")  # magic, version
+STREAM_HEADER_V1 = struct.Struct(">4sBI8s")  # magic, version, chunk size, nonce prefix
+STREAM_HEADER = struct.Struct(">4sBBI8s")  # magic, version, codec, chunk size, nonce prefix
+FRAME_HEADER = struct.Struct(">IB")  # ciphertext length, frame flags
+FRAME_FINAL = 1
+FRAME_COMPRESSED = 2
+TAG_SIZE = 16
 
-class FileSharingServer:
+# Envelope encryption: every block and encrypted blob is sealed with its own random data key, and only the
+# data keys are wrapped by the master keys in KEY_FILE (one per line, newest first), so rotation never touches payloads
+DATA_KEY_SIZE = 32
+KEY_WRAP_HEADER = struct.Struct(">8s12s")  # master key id, nonce
+LEGACY_KEY_NAME = "legacy"
+BLOCK_ID_KEY_NAME = "block-id"
+ROTATION_BATCH = 10000
+
+# Read cache: decrypted blocks keyed by their content hash, split into a probation and a protected LRU segment
+# so a large file read once can't push out blocks that are read again and again
+BLOCK_CACHE_SIZE = 256 * 1024 * 1024
+BLOCK_CACHE_PROTECTED = 0.8  # Share of the cache kept for blocks read more than once
+
+# Metrics: per-operation latency histograms and byte counters in Prometheus text format, off unless enabled
+METRICS_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)  # Seconds
+METRICS_FILE_INTERVAL = 15  # Seconds between rewrites of the metrics file
+TRACE_SPANS = 10000  # Finished spans kept for inspection
+
+# Compression before encryption: the codec is chosen per file by compressing a sample, and each frame
+# is only stored compressed if that actually made it smaller
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+ZLIB_LEVEL = 3
+ZSTD_LEVEL = 3
+COMPRESSION_SAMPLE_SIZE = 64 * 1024
+COMPRESSION_MIN_SAVING = 0.1  # Skip compression unless the sample shrinks by at least 10%
+READ_AHEAD_DEPTH = 4
+
+# Network protocol: a request header and file name, then bodies sent as length-prefixed frames ending with an empty frame
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 9000
+REQUEST_HEADER = struct.Struct(">BHQQ")  # opcode, file name length, range offset, range length
+RESPONSE_HEADER = struct.Struct(">B")  # status
+BODY_FRAME = struct.Struct(">I")  # frame length
+OP_UPLOAD = 1
+OP_DOWNLOAD = 2
+OP_LIST = 3
+OP_VERSION = 4
+OP_REMOVE = 5
+OP_STAT = 6
+OP_READ_RANGE = 7
+OP_LIST_VERSIONS = 8
+OP_GET_VERSION = 9
+OP_PUT_BLOCK = 10
+OP_GET_BLOCK = 11
+OP_DELETE_BLOCK = 12
+OP_PING = 13
+OP_REPLACE = 14
+STATUS_OK = 0
+STATUS_NOT_FOUND = 1
+STATUS_EXISTS = 2
+STATUS_ERROR = 3
+STATUS_CONFLICT = 4
+
+# Cluster mode: encrypted blocks are placed on storage nodes by consistent hashing with virtual nodes
+VIRTUAL_NODES = 64
+REPLICATION_FACTOR = 2
+WRITE_QUORUM = REPLICATION_FACTOR  # Replicas that must accept a new block; replicas that miss it are copied again on repair
+NODE_TIMEOUT = 5
+NODE_RETRY_SECONDS = 10  # How long a node that failed a request is tried last
+NODE_BLOCKS_FOLDER = "node_blocks"
+
+# Batch transfers: chunking and hashing run on a process pool, disk and server I/O on BATCH_IO_WORKERS threads
+BATCH_IO_WORKERS = 4
+
+# Ranged downloads: files are fetched in RANGE_SIZE pieces over several streams and resumed from a progress file
+DOWNLOAD_STREAMS = 4
+RANGE_SIZE = 8 * 1024 * 1024
+PARTIAL_SUFFIX = ".part"
+PROGRESS_SUFFIX = ".progress"
+
+# Content-defined chunking (FastCDC): cut points come from a gear rolling hash so an edit only changes nearby chunks
+CDC_MIN_SIZE = 16 * 1024
+CDC_AVG_SIZE = 64 * 1024
+CDC_MAX_SIZE = 256 * 1024
+CDC_MASK_SMALL = (1 << 18) - 1  # Harder to match before the average size
+CDC_MASK_LARGE = (1 << 14) - 1  # Easier to match after the average size
+# Only the low mask bits are tested, so the fingerprint is kept to 30 bits to stay a single-digit Python int
+GEAR_MASK = (1 << 30) - 1
+GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], "big") & GEAR_MASK for i in range(256)]
+
+
+def iter_chunks(data, chunk_size=STREAM_CHUNK_SIZE):
+    # Yield successive chunks from a bytes-like object or a binary file object
+    if hasattr(data, "read"):
+        while True:
+            chunk = data.read(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+    else:
+        view = memoryview(data)
+        for offset in range(0, len(view), chunk_size):
+            yield view[offset:offset + chunk_size]
+
+
+def iter_buffers(data, buffer_size=STREAM_CHUNK_SIZE, depth=READ_AHEAD_DEPTH):
+    # Yield memoryviews over data without copying it; each view is only valid until the next one is requested
+    if not hasattr(data, "read"):
+        yield from iter_chunks(data, buffer_size)
+        return
+    if not hasattr(data, "readinto"):
+        yield from read_ahead(iter_chunks(data, buffer_size), depth)
+        return
+    # Files are read on a background thread into a fixed pool of reusable buffers
+    free_buffers = queue.Queue()
+    for _ in range(depth + 2):
+        free_buffers.put(bytearray(buffer_size))
+
+    def fill():
+        while True:
+            buffer = free_buffers.get()
+            size = data.readinto(buffer)
+            if not size:
+                return
+            yield buffer, size
+
+    try:
+        for buffer, size in read_ahead(fill(), depth):
+            with memoryview(buffer) as view:
+                yield view[:size]
+            free_buffers.put(buffer)
+    finally:
+        # Wake the reader if it is waiting for a buffer after the consumer stopped early
+        free_buffers.put(bytearray(0))
+
+
+def check_file_name(file_name):
+    # File names become paths under the storage folders, so they must be a single plain path component
+    if not file_name or file_name in (".", "..") or "\0" in file_name or os.path.basename(file_name) != file_name:
+        raise ValueError(f"Invalid file name '{file_name}'.")
+
+
+def atomic_write(path, chunks, journal=None):
+    # Write chunks to a temporary file and rename it over path, so readers and crashes never see a partial file.
+    # With a journal the fsync is left to its next group commit, otherwise it happens here
+    temporary_path = f"{path}.{os.getpid()}.{threading.get_ident()}{TEMPORARY_SUFFIX}"
+    try:
+        with open(temporary_path, "wb") as file:
+            for chunk in chunks:
+                file.write(chunk)
+            if journal is None:
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(temporary_path, path)
+    except BaseException:
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+        raise
+    if journal is None:
+        fsync_path(os.path.dirname(path) or ".")
+    else:
+        journal.track(path)
+
+
+def fsync_path(path):
+    # Flush a file or directory (for renames and new entries) to disk; it may have been deleted since
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except FileNotFoundError:
+        return
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def read_ahead(iterable, depth=READ_AHEAD_DEPTH):
+    # Pull items from the iterable on a background thread so disk reads overlap with encryption
+    items = queue.Queue(depth)
+    stop = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stop.is_set():
+                    try:
+                        items.put((item, None), timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():
+                    return
+            items.put((done, None))
+        except Exception as error:
+            items.put((done, error))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+def find_cut_point(data, start, end):
+    # Return the end offset of the next content-defined chunk in data[start:end]
+    size = end - start
+    if size <= CDC_MIN_SIZE:
+        return end
+    normal = start + min(size, CDC_AVG_SIZE)
+    limit = start + min(size, CDC_MAX_SIZE)
+    gear = GEAR
+    fingerprint = 0
+    # Bytes below the minimum size never cut, so skip hashing them
+    i = start + CDC_MIN_SIZE
+    with memoryview(data) as view:
+        # Iterating a slice is much faster in CPython than indexing data[i]
+        for byte in view[i:normal]:
+            fingerprint = ((fingerprint << 1) + gear[byte]) & GEAR_MASK
+            i += 1
+            if not fingerprint & CDC_MASK_SMALL:
+                return i
+        for byte in view[i:limit]:
+            fingerprint = ((fingerprint << 1) + gear[byte]) & GEAR_MASK
+            i += 1
+            if not fingerprint & CDC_MASK_LARGE:
+                return i
+    return limit
+
+
+def cdc_chunks(chunks):
+    # Re-split a stream of byte chunks into content-defined chunks
+    buffer = bytearray()
+    offset = 0
+    for data in chunks:
+        buffer += data
+        while len(buffer) - offset >= CDC_MAX_SIZE:
+            cut = find_cut_point(buffer, offset, len(buffer))
+            yield bytes(buffer[offset:cut])
+            offset = cut
+        # Drop consumed bytes once per input chunk instead of once per output chunk
+        del buffer[:offset]
+        offset = 0
+    while offset < len(buffer):
+        cut = find_cut_point(buffer, offset, len(buffer))
+        yield bytes(buffer[offset:cut])
+        offset = cut
+
+
+def planned_chunks(chunks, chunk_sizes):
+    # Re-split a stream of byte chunks at boundaries found earlier by cdc_chunks
+    sizes = iter(chunk_sizes)
+    size = next(sizes, None)
+    buffer = bytearray()
+    offset = 0
+    for data in chunks:
+        buffer += data
+        while size is not None and len(buffer) - offset >= size:
+            yield bytes(buffer[offset:offset + size])
+            offset += size
+            size = next(sizes, None)
+        del buffer[:offset]
+        offset = 0
+    if buffer or size is not None:
+        raise ValueError("File changed after its chunks were planned.")
+
+
+def plan_chunks(file_path, server_sha256=None):
+    # Hash a file and find its chunk boundaries; runs in a worker process so chunking scales across cores.
+    # When the server already has a file by this name, a plain hash first checks whether chunking is needed at all.
+    if server_sha256 is not None:
+        sha256 = hash_path(file_path)
+        if sha256 == server_sha256:
+            return {"size": os.path.getsize(file_path), "sha256": sha256, "chunk_sizes": None}
+    hash_object = hashlib.sha256()
+    chunk_sizes = []
+    with open(file_path, "rb") as file:
+        for chunk in cdc_chunks(iter_buffers(file)):
+            hash_object.update(chunk)
+            chunk_sizes.append(len(chunk))
+    return {"size": sum(chunk_sizes), "sha256": hash_object.hexdigest(), "chunk_sizes": chunk_sizes}
+
+
+def hash_path(file_path):
+    # SHA256 of a file on disk; runs in a worker process
+    hash_object = hashlib.sha256()
+    with open(file_path, "rb") as file:
+        for view in iter_buffers(file):
+            hash_object.update(view)
+    return hash_object.hexdigest()
+
+
+def diff_chunks(base, target):
+    # Encode target's chunk list as copies of runs from base plus inserted chunks, rsync style
+    positions = {}
+    for position, (block_hash, _) in enumerate(base):
+        positions.setdefault(block_hash, position)
+    ops = []
+    i = 0
+    while i < len(target):
+        j = positions.get(target[i][0])
+        if j is None:
+            if ops and ops[-1][0] == "insert":
+                ops[-1][1].append(target[i])
+            else:
+                ops.append(["insert", [target[i]]])
+            i += 1
+            continue
+        run = 1
+        while i + run < len(target) and j + run < len(base) and base[j + run][0] == target[i + run][0]:
+            run += 1
+        ops.append(["copy", j, run])
+        i += run
+    return ops
+
+
+def apply_chunk_delta(base, ops):
+    # Rebuild a chunk list from its base and the ops produced by diff_chunks
+    chunks = []
+    for op in ops:
+        if op[0] == "copy":
+            chunks.extend(base[op[1]:op[1] + op[2]])
+        else:
+            chunks.extend(op[1])
+    return chunks
+
+
+def compress(codec, data):
+    if codec == CODEC_ZSTD:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    return zlib.compress(data, ZLIB_LEVEL)
+
+
+def decompress(codec, data, max_size):
+    # Refuse frames that expand beyond the stream chunk size
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise InvalidToken  # Written by a server with zstandard installed
+        data = zstandard.ZstdDecompressor().decompress(data, max_output_size=max_size)
+    elif codec == CODEC_ZLIB:
+        decompressor = zlib.decompressobj()
+        data = decompressor.decompress(data, max_size)
+        if decompressor.unconsumed_tail:
+            raise InvalidToken
+    else:
+        raise InvalidToken
+    if len(data) > max_size:
+        raise InvalidToken
+    return data
+
+
+def choose_codec(sample):
+    # Compress a sample of the data and only use a codec if it saves enough
+    sample = sample[:COMPRESSION_SAMPLE_SIZE]
+    if not sample:
+        return CODEC_NONE
+    codec = CODEC_ZSTD if zstandard is not None else CODEC_ZLIB
+    if len(compress(codec, sample)) > len(sample) * (1 - COMPRESSION_MIN_SAVING):
+        return CODEC_NONE
+    return codec
+
+
+def stream_key(key):
+    # The AES-256-GCM key that streams written before envelope encryption derived from the Fernet master key
+    hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"fss stream v1")
+    return hkdf.derive(base64.urlsafe_b64decode(key))
+
+
+class Keyring:
+    def __init__(self, keys):
+        # Master keys, newest first: data keys are wrapped with the first and unwrapped with whichever wrapped them,
+        # like MultiFernet but with AES-GCM and a key id so rewrapping millions of keys stays cheap
+        self.keys = list(keys)
+        self.wrappers = {}
+        for key in reversed(self.keys):
+            material = base64.urlsafe_b64decode(key)
+            hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=b"fss key wrap v1")
+            self.primary = hashlib.sha256(material).digest()[:8]
+            self.wrappers[self.primary] = AESGCM(hkdf.derive(material))
+
+    def wrap(self, data_key):
+        nonce = os.urandom(12)
+        return KEY_WRAP_HEADER.pack(self.primary, nonce) + self.wrappers[self.primary].encrypt(nonce, data_key, self.primary)
+
+    def unwrap(self, wrapped):
+        if len(wrapped) < KEY_WRAP_HEADER.size:
+            raise InvalidToken
+        key_id, nonce = KEY_WRAP_HEADER.unpack_from(wrapped)
+        if key_id not in self.wrappers:
+            raise InvalidToken  # Wrapped by a master key that is no longer in the keyring
+        try:
+            return self.wrappers[key_id].decrypt(nonce, wrapped[KEY_WRAP_HEADER.size:], key_id)
+        except InvalidTag:
+            raise InvalidToken
+
+    def rotate(self, wrapped):
+        # Rewrap a data key under the primary master key; returns None if it already is
+        if wrapped[:8] == self.primary:
+            return None
+        return self.wrap(self.unwrap(wrapped))
+
+
+class ChunkedCipher:
+    def __init__(self):
+        # AES-256-GCM streams, each sealed with the data key it is given
+        self.stats_lock = threading.Lock()
+        self.compression_stats = {"bytes_in": 0, "bytes_out": 0, "seconds": 0.0}
+
+    def encrypt_stream(self, chunks, data_key, codec=None):
+        # Yield the stream header followed by one authenticated frame per plaintext chunk;
+        # with no codec given, one is chosen by sampling the first chunk
+        aead = AESGCM(data_key)
+        chunks = iter(chunks)
+        first = next(chunks, b"")
+        if codec is None:
+            codec = choose_codec(first)
+        header = STREAM_HEADER.pack(STREAM_MAGIC, STREAM_VERSION, codec, STREAM_CHUNK_SIZE, os.urandom(8))
+        yield header
+        counter = 0
+        pending = b""
+        for chunk in itertools.chain([first], chunks):
+            if not chunk:
+                continue
+            if len(chunk) > STREAM_CHUNK_SIZE:
+                raise ValueError("Chunk larger than the stream chunk size.")
+            if pending:
+                yield self._seal(aead, header, codec, counter, pending, False)
+                counter += 1
+            pending = chunk
+        # The last frame is flagged so a truncated stream fails to decrypt
+        yield self._seal(aead, header, codec, counter, pending, True)
+
+    def decrypt_stream(self, file, data_key):
+        # Yield plaintext chunks from a binary file object positioned at the stream header
+        aead = AESGCM(data_key)
+        prefix = file.read(STREAM_PREFIX.size)
+        if len(prefix) < STREAM_PREFIX.size:
+            raise InvalidToken
+        magic, version = STREAM_PREFIX.unpack(prefix)
+        if magic != STREAM_MAGIC or version not in (1, STREAM_VERSION):
+            raise InvalidToken
+        header_struct = STREAM_HEADER_V1 if version == 1 else STREAM_HEADER
+        header = prefix + file.read(header_struct.size - STREAM_PREFIX.size)
+        if len(header) < header_struct.size:
+            raise InvalidToken
+        if version == 1:
+            codec = CODEC_NONE
+            _, _, chunk_size, _ = header_struct.unpack(header)
+        else:
+            _, _, codec, chunk_size, _ = header_struct.unpack(header)
+        counter = 0
+        while True:
+            frame_header = file.read(FRAME_HEADER.size)
+            if len(frame_header) < FRAME_HEADER.size:
+                raise InvalidToken  # Stream ended before the final frame
+            length, flags = FRAME_HEADER.unpack(frame_header)
+            if length > chunk_size + TAG_SIZE:
+                raise InvalidToken
+            ciphertext = file.read(length)
+            if len(ciphertext) < length:
+                raise InvalidToken
+            try:
+                chunk = aead.decrypt(self._nonce(header, counter), ciphertext, header + bytes([flags]))
+            except InvalidTag:
+                raise InvalidToken
+            yield decompress(codec, chunk, chunk_size) if flags & FRAME_COMPRESSED else chunk
+            if flags & FRAME_FINAL:
+                if file.read(1):
+                    raise InvalidToken  # Trailing data after the final frame
+                return
+            counter += 1
+
+    def _nonce(self, header, counter):
+        # Per-frame nonce: the random prefix from the header plus the frame counter
+        return header[-8:] + struct.pack(">I", counter)
+
+    def _seal(self, aead, header, codec, counter, chunk, final):
+        flags = FRAME_FINAL if final else 0
+        if codec != CODEC_NONE and chunk:
+            start = time.perf_counter()
+            compressed = compress(codec, chunk)
+            with self.stats_lock:
+                self.compression_stats["bytes_in"] += len(chunk)
+                self.compression_stats["bytes_out"] += min(len(compressed), len(chunk))
+                self.compression_stats["seconds"] += time.perf_counter() - start
+            # Frames that don't shrink are stored as they are
+            if len(compressed) < len(chunk):
+                chunk = compressed
+                flags |= FRAME_COMPRESSED
+        ciphertext = aead.encrypt(self._nonce(header, counter), chunk, header + bytes([flags]))
+        return FRAME_HEADER.pack(len(ciphertext), flags) + ciphertext
+
+
+class BlockCache:
+    def __init__(self, max_bytes=BLOCK_CACHE_SIZE):
+        # Segmented LRU bounded by bytes: new blocks enter probation and move to protected on their second hit
+        self.max_bytes = max_bytes
+        self.max_protected_bytes = int(max_bytes * BLOCK_CACHE_PROTECTED)
+        self.lock = threading.Lock()
+        self.probation = collections.OrderedDict()
+        self.protected = collections.OrderedDict()
+        self.size = 0
+        self.protected_size = 0
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    def get(self, block_hash):
+        with self.lock:
+            data = self.protected.get(block_hash)
+            if data is not None:
+                self.protected.move_to_end(block_hash)
+            else:
+                data = self.probation.pop(block_hash, None)
+                if data is None:
+                    self.counters["misses"] += 1
+                    return None
+                self.protected[block_hash] = data
+                self.protected_size += len(data)
+                # Demote the least recently used protected blocks once the segment is full
+                while self.protected_size > self.max_protected_bytes and len(self.protected) > 1:
+                    demoted_hash, demoted = self.protected.popitem(last=False)
+                    self.protected_size -= len(demoted)
+                    self.probation[demoted_hash] = demoted
+            self.counters["hits"] += 1
+            return data
+
+    def put(self, block_hash, data):
+        # Blocks too big to share the cache fairly are not cached
+        if len(data) > self.max_bytes // 8:
+            return
+        with self.lock:
+            if block_hash in self.probation or block_hash in self.protected:
+                return
+            self.probation[block_hash] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                if self.probation:
+                    _, evicted = self.probation.popitem(last=False)
+                else:
+                    _, evicted = self.protected.popitem(last=False)
+                    self.protected_size -= len(evicted)
+                self.size -= len(evicted)
+                self.counters["evictions"] += 1
+
+    def discard(self, block_hashes):
+        # Drop blocks that were deleted from the store
+        with self.lock:
+            for block_hash in block_hashes:
+                data = self.probation.pop(block_hash, None)
+                if data is None:
+                    data = self.protected.pop(block_hash, None)
+                    if data is not None:
+                        self.protected_size -= len(data)
+                if data is not None:
+                    self.size -= len(data)
+                    self.counters["invalidations"] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters, bytes=self.size, max_bytes=self.max_bytes, blocks=len(self.probation) + len(self.protected))
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = stats["hits"] / lookups if lookups else 0.0
+        return stats
+
+
+class BlockStore:
+    def __init__(self, cipher, keyring, folder=BLOCKS_FOLDER, cache_size=BLOCK_CACHE_SIZE, journal=None):
+        # Encrypted chunks are stored once under a keyed hash of their plaintext and reference counted,
+        # each with its own data key wrapped by the keyring
+        self.cipher = cipher
+        self.keyring = keyring
+        self.folder = folder
+        self.journal = journal
+        self.cache = BlockCache(cache_size)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        self.lock = threading.Lock()
+        self.writing = {}  # Hashes of blocks being written or deleted, so a concurrent put waits instead of racing
+        self.pinned = collections.Counter()  # Blocks being read, which garbage collection leaves alone
+        self.db = sqlite3.connect(os.path.join(folder, BLOCK_INDEX_FILE), check_same_thread=False)
+        # Commits are made durable by the journal's group commit fsyncing the WAL file
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS blocks (hash TEXT PRIMARY KEY, size INTEGER, stored_size INTEGER, refs INTEGER, data_key BLOB)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS blocks_refs ON blocks (refs)")
+        # Block stores created before envelope encryption lack the data key column
+        if "data_key" not in [row[1] for row in self.db.execute("PRAGMA table_info(blocks)")]:
+            self.db.execute("ALTER TABLE blocks ADD COLUMN data_key BLOB")
+        self.db.execute("CREATE TABLE IF NOT EXISTS data_keys (name TEXT PRIMARY KEY, wrapped BLOB)")
+        self.db.commit()
+        # Statistics scan the whole table, so they read through their own connection: in WAL mode that doesn't block
+        # writers, and puts and reference updates never wait on self.lock for a scrape
+        self.stats_db = sqlite3.connect(os.path.join(folder, BLOCK_INDEX_FILE), check_same_thread=False)
+        self.stats_lock = threading.Lock()
+        self.legacy_key = self.named_key(LEGACY_KEY_NAME)
+        if self.legacy_key is None:
+            # Data written before envelope encryption used the master key itself; keeping it as a wrapped
+            # data key lets the master key rotate without re-encrypting that data
+            self.legacy_key = keyring.keys[0]
+            self.set_named_key(LEGACY_KEY_NAME, self.legacy_key)
+        self.legacy_stream_key = stream_key(self.legacy_key)
+        # Block ids are an HMAC of the chunk, so block names on disk or on storage nodes can't be matched
+        # against the SHA256 of known content; the secret is a wrapped data key, so it survives key rotation
+        self.block_id_key = self.named_key(BLOCK_ID_KEY_NAME)
+        if self.block_id_key is None:
+            self.block_id_key = os.urandom(DATA_KEY_SIZE)
+            self.set_named_key(BLOCK_ID_KEY_NAME, self.block_id_key)
+
+    def block_id(self, data):
+        return hmac.new(self.block_id_key, data, hashlib.sha256).hexdigest()
+
+    def named_key(self, name):
+        # Unwrapped data key stored under a name, or None
+        with self.lock:
+            row = self.db.execute("SELECT wrapped FROM data_keys WHERE name = ?", (name,)).fetchone()
+        return None if row is None else self.keyring.unwrap(row[0])
+
+    def set_named_key(self, name, data_key):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO data_keys VALUES (?, ?)", (name, self.keyring.wrap(data_key)))
+            self.db.commit()
+
+    def delete_named_key(self, name):
+        with self.lock:
+            self.db.execute("DELETE FROM data_keys WHERE name = ?", (name,))
+            self.db.commit()
+
+    def block_path(self, block_hash):
+        # Fan blocks out over 256 subfolders to keep directories small
+        return os.path.join(self.folder, block_hash[:2], block_hash)
+
+    def write_blob(self, block_hash, blob):
+        block_path = self.block_path(block_hash)
+        os.makedirs(os.path.dirname(block_path), exist_ok=True)
+        atomic_write(block_path, [blob], self.journal)
+
+    def read_blob(self, block_hash):
+        # Return the encrypted bytes of a block
+        with open(self.block_path(block_hash), "rb") as file:
+            return file.read()
+
+    def delete_blob(self, block_hash):
+        if os.path.exists(self.block_path(block_hash)):
+            os.remove(self.block_path(block_hash))
+
+    def put(self, block_hash, data, codec=CODEC_NONE):
+        # Store a block and take a reference to it; returns True if the block was new
+        with self.lock:
+            updated = self.db.execute("UPDATE blocks SET refs = refs + 1 WHERE hash = ?", (block_hash,)).rowcount
+            self.db.commit()
+            if not updated:
+                writing = self.writing.get(block_hash)
+                if writing is None:
+                    self.writing[block_hash] = threading.Event()
+        if updated:
+            return False
+        if writing is not None:
+            # Another thread is writing the same new block; take a reference once it is stored
+            writing.wait()
+            return self.put(block_hash, data, codec)
+        # Encrypt and write outside the lock
+        try:
+            data_key = os.urandom(DATA_KEY_SIZE)
+            blob = b"".join(self.cipher.encrypt_stream(iter_chunks(data), data_key, codec))
+            self.write_blob(block_hash, blob)
+            with self.lock:
+                self.db.execute("INSERT INTO blocks (hash, size, stored_size, refs, data_key) VALUES (?, ?, ?, 1, ?)", (block_hash, len(data), len(blob), self.keyring.wrap(data_key)))
+                self.db.commit()
+        finally:
+            with self.lock:
+                self.writing.pop(block_hash).set()
+        return True
+
+    def data_key(self, block_hash):
+        # Blocks written before envelope encryption have no data key of their own
+        with self.lock:
+            row = self.db.execute("SELECT data_key FROM blocks WHERE hash = ?", (block_hash,)).fetchone()
+        return self.legacy_stream_key if row is None or row[0] is None else self.keyring.unwrap(row[0])
+
+    def get(self, block_hash):
+        # Read, decrypt and verify a block, or serve it from the cache; blocks never change once stored
+        data = self.cache.get(block_hash)
+        if data is not None:
+            return data
+        data = b"".join(self.cipher.decrypt_stream(io.BytesIO(self.read_blob(block_hash)), self.data_key(block_hash)))
+        # Blocks stored before keyed ids are named by their plain SHA256
+        if not hmac.compare_digest(self.block_id(data), block_hash) and hashlib.sha256(data).hexdigest() != block_hash:
+            raise InvalidToken
+        self.cache.put(block_hash, data)
+        return data
+
+    def add_refs(self, block_hashes, delta=1):
+        # Adjust reference counts, once per occurrence of each hash
+        with self.lock:
+            self.db.executemany("UPDATE blocks SET refs = refs + ? WHERE hash = ?", [(delta, block_hash) for block_hash in block_hashes])
+            self.db.commit()
+
+    def pin(self, block_hashes):
+        # Keep blocks from being collected while a reader streams them, even if their file is replaced or removed
+        with self.lock:
+            self.pinned.update(block_hashes)
+
+    def unpin(self, block_hashes):
+        # Unpinned blocks without references are deleted by the next collection
+        with self.lock:
+            for block_hash in block_hashes:
+                self.pinned[block_hash] -= 1
+                if self.pinned[block_hash] <= 0:
+                    del self.pinned[block_hash]
+
+    def collect_garbage(self):
+        # Delete blocks that no manifest references any more; returns the number of bytes freed
+        with self.lock:
+            rows = [row for row in self.db.execute("SELECT hash, stored_size FROM blocks WHERE refs <= 0") if row[0] not in self.pinned]
+            self.db.executemany("DELETE FROM blocks WHERE hash = ?", [(block_hash,) for block_hash, _ in rows])
+            self.db.commit()
+            # Deleting can mean a network round trip per replica, so it happens outside the lock;
+            # a put of the same block meanwhile waits as if another thread were writing it
+            for block_hash, _ in rows:
+                self.writing[block_hash] = threading.Event()
+        try:
+            for block_hash, _ in rows:
+                self.delete_blob(block_hash)
+        finally:
+            with self.lock:
+                for block_hash, _ in rows:
+                    self.writing.pop(block_hash).set()
+        self.cache.discard(block_hash for block_hash, _ in rows)
+        return sum(stored_size for _, stored_size in rows)
+
+    def set_refs(self, counts):
+        # Replace every reference count, e.g. with counts recomputed from the manifests after a crash
+        with self.lock:
+            self.db.execute("UPDATE blocks SET refs = 0")
+            self.db.executemany("UPDATE blocks SET refs = ? WHERE hash = ?", [(count, block_hash) for block_hash, count in counts.items()])
+            self.db.commit()
+
+    def sweep(self):
+        # Delete block files without a row (written just before a crash) and leftover temporary files
+        with self.lock:
+            known = {block_hash for (block_hash,) in self.db.execute("SELECT hash FROM blocks")}
+        removed = 0
+        for folder in os.scandir(self.folder):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                if entry.name.endswith(TEMPORARY_SUFFIX) or entry.name not in known:
+                    os.remove(entry.path)
+                    removed += 1
+        return removed
+
+    def rewrap(self):
+        # Rewrap every data key under the keyring's primary master key in batches; payloads are not touched
+        rewrapped = 0
+        for table, key_column in (("blocks", "data_key"), ("data_keys", "wrapped")):
+            after = 0
+            while True:
+                # Walk the table in rowid order so the updates touch pages sequentially
+                with self.lock:
+                    rows = self.db.execute(f"SELECT rowid, {key_column} FROM {table} WHERE rowid > ? AND {key_column} IS NOT NULL ORDER BY rowid LIMIT ?", (after, ROTATION_BATCH)).fetchall()
+                if not rows:
+                    break
+                updates = [(rotated, rowid, wrapped) for rowid, wrapped, rotated in ((rowid, wrapped, self.keyring.rotate(wrapped)) for rowid, wrapped in rows) if rotated is not None]
+                with self.lock:
+                    # Skip keys replaced since they were read
+                    self.db.executemany(f"UPDATE {table} SET {key_column} = ? WHERE rowid = ? AND {key_column} = ?", updates)
+                    self.db.commit()
+                rewrapped += len(updates)
+                after = rows[-1][0]
+        return rewrapped
+
+    def stats(self):
+        # Logical bytes referenced, plaintext bytes of the distinct blocks, and bytes actually stored
+        with self.stats_lock:
+            logical, unique, stored = self.stats_db.execute(
+                "SELECT COALESCE(SUM(size * refs), 0), COALESCE(SUM(CASE WHEN refs > 0 THEN size ELSE 0 END), 0), COALESCE(SUM(stored_size), 0) FROM blocks"
+            ).fetchone()
+        return {"logical_bytes": logical, "unique_bytes": unique, "stored_bytes": stored}
+
+
+class HashRing:
+    def __init__(self, nodes=(), virtual_nodes=VIRTUAL_NODES):
+        # Each node owns many points on the ring so keys spread evenly and a join or leave moves about 1/N of them
+        self.virtual_nodes = virtual_nodes
+        self.points = []
+        for node in nodes:
+            self.add(node)
+
+    def position(self, key):
+        return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "big")
+
+    def add(self, node):
+        for i in range(self.virtual_nodes):
+            bisect.insort(self.points, (self.position(f"{node}#{i}"), node))
+
+    def remove(self, node):
+        self.points = [point for point in self.points if point[1] != node]
+
+    def copy(self):
+        ring = HashRing(virtual_nodes=self.virtual_nodes)
+        ring.points = list(self.points)
+        return ring
+
+    def owners(self, key, count):
+        # The first count distinct nodes clockwise from the key's position
+        owners = []
+        start = bisect.bisect(self.points, (self.position(key),))
+        for i in range(len(self.points)):
+            node = self.points[(start + i) % len(self.points)][1]
+            if node not in owners:
+                owners.append(node)
+                if len(owners) == count:
+                    break
+        return owners
+
+
+def recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Connection closed by peer.")
+        data += chunk
+    return bytes(data)
+
+
+class NodeClient:
+    def __init__(self, address):
+        # Blocking client for one storage node, with a pool of idle connections and a latency estimate
+        self.address = address
+        host, port = address.rsplit(":", 1)
+        self.host = host
+        self.port = int(port)
+        self.idle = queue.LifoQueue()
+        self.latency = 0.0
+        self.failed_at = None
+
+    def rank(self):
+        # Healthy nodes first, then the fastest
+        recently_failed = self.failed_at is not None and time.monotonic() - self.failed_at < NODE_RETRY_SECONDS
+        return (recently_failed, self.latency)
+
+    def request(self, opcode, name, body=None):
+        # Send one request and return (status, response body)
+        try:
+            sock = self.idle.get_nowait()
+        except queue.Empty:
+            sock = None
+        start = time.monotonic()
+        try:
+            if sock is None:
+                sock = socket.create_connection((self.host, self.port), timeout=NODE_TIMEOUT)
+            name = name.encode()
+            message = bytearray(REQUEST_HEADER.pack(opcode, len(name), 0, 0) + name)
+            if body:
+                message += BODY_FRAME.pack(len(body)) + body
+            if body is not None:
+                message += BODY_FRAME.pack(0)
+            sock.sendall(message)
+            (status,) = RESPONSE_HEADER.unpack(recv_exactly(sock, RESPONSE_HEADER.size))
+            response = bytearray()
+            while True:
+                (length,) = BODY_FRAME.unpack(recv_exactly(sock, BODY_FRAME.size))
+                if not length:
+                    break
+                response += recv_exactly(sock, length)
+        except OSError:
+            if sock is not None:
+                sock.close()
+            self.failed_at = time.monotonic()
+            raise
+        self.idle.put(sock)
+        self.failed_at = None
+        # Exponentially weighted moving average of request time
+        self.latency = 0.8 * self.latency + 0.2 * (time.monotonic() - start)
+        if status == STATUS_ERROR:
+            raise RuntimeError(response.decode())
+        return status, bytes(response)
+
+
+class ClusterBlockStore(BlockStore):
+    def __init__(self, cipher, keyring, nodes, replication_factor=REPLICATION_FACTOR, folder=BLOCKS_FOLDER, cache_size=BLOCK_CACHE_SIZE, journal=None, write_quorum=WRITE_QUORUM):
+        # Reference counts and data keys stay local while encrypted blocks live on the storage nodes that own them
+        super().__init__(cipher, keyring, folder, cache_size, journal)
+        self.replication_factor = replication_factor
+        self.write_quorum = write_quorum
+        # Blocks missing from some of their owners, kept until rebalance or repair copies them there
+        with self.lock:
+            self.db.execute("CREATE TABLE IF NOT EXISTS under_replicated (hash TEXT PRIMARY KEY)")
+            self.db.commit()
+        self.nodes = {address: NodeClient(address) for address in nodes}
+        self.ring = HashRing(nodes)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max(4, 2 * len(nodes)))
+
+    def owners(self, block_hash, ring=None):
+        return [self.nodes[address] for address in (ring or self.ring).owners(block_hash, self.replication_factor)]
+
+    def write_blob(self, block_hash, blob):
+        # Write to every replica in parallel; the write quorum has to accept the block, and the rest get it on repair
+        def write(node):
+            try:
+                node.request(OP_PUT_BLOCK, block_hash, blob)
+                return True
+            except (OSError, RuntimeError):
+                return False
+        owners = self.owners(block_hash)
+        written = list(self.executor.map(write, owners))
+        if sum(written) < min(self.write_quorum, len(owners)):
+            self.delete_blob(block_hash, [node for node, ok in zip(owners, written) if ok])
+            raise IOError(f"Only {sum(written)} of {len(owners)} storage nodes accepted block {block_hash}.")
+        if not all(written):
+            with self.lock:
+                self.db.execute("INSERT OR IGNORE INTO under_replicated VALUES (?)", (block_hash,))
+                self.db.commit()
+
+    def read_blob(self, block_hash, ring=None):
+        # Read from the fastest healthy replica, falling back to the others
+        for node in sorted(self.owners(block_hash, ring), key=NodeClient.rank):
+            try:
+                status, blob = node.request(OP_GET_BLOCK, block_hash)
+            except (OSError, RuntimeError):
+                continue
+            if status == STATUS_OK:
+                return blob
+        raise IOError(f"No storage node could return block {block_hash}.")
+
+    def delete_blob(self, block_hash, nodes=None):
+        for node in nodes or self.owners(block_hash):
+            try:
+                node.request(OP_DELETE_BLOCK, block_hash)
+            except (OSError, RuntimeError):
+                pass
+
+    def add_node(self, address):
+        # Join a node and move to it only the blocks it now owns; returns the number of copies made
+        old_ring = self.ring.copy()
+        self.nodes[address] = NodeClient(address)
+        self.ring.add(address)
+        return self.rebalance(old_ring)
+
+    def remove_node(self, address):
+        # Drop a node and re-replicate the blocks it owned from their other replicas
+        old_ring = self.ring.copy()
+        self.ring.remove(address)
+        try:
+            return self.rebalance(old_ring)
+        finally:
+            del self.nodes[address]
+
+    def repair(self):
+        # Copy blocks that missed a replica when they were written to all of their owners
+        return self.rebalance(self.ring)
+
+    def rebalance(self, old_ring):
+        # Copy blocks whose owners changed, or that are under-replicated, to their new owners and delete them from
+        # nodes that no longer own them; returns the copies made and the hashes that couldn't be copied.
+        # A block that fails stays on its old owners and is retried by the next rebalance or repair
+        with self.lock:
+            block_hashes = [block_hash for (block_hash,) in self.db.execute("SELECT hash FROM blocks")]
+            under_replicated = {block_hash for (block_hash,) in self.db.execute("SELECT hash FROM under_replicated")}
+        moved = 0
+        failed = []
+        for block_hash in block_hashes:
+            old_owners = old_ring.owners(block_hash, self.replication_factor)
+            new_owners = self.ring.owners(block_hash, self.replication_factor)
+            if block_hash in under_replicated:
+                gained = [self.nodes[address] for address in new_owners]
+            else:
+                gained = [self.nodes[address] for address in new_owners if address not in old_owners]
+            lost = [self.nodes[address] for address in old_owners if address not in new_owners]
+            if gained:
+                try:
+                    try:
+                        blob = self.read_blob(block_hash, old_ring)
+                    except IOError:
+                        blob = self.read_blob(block_hash)
+                    for node in gained:
+                        node.request(OP_PUT_BLOCK, block_hash, blob)
+                        moved += 1
+                except (OSError, RuntimeError):
+                    failed.append(block_hash)
+                    continue
+            if lost:
+                self.delete_blob(block_hash, lost)
+        with self.lock:
+            # Blocks written during the rebalance may have been added since it started and stay listed
+            self.db.executemany("DELETE FROM under_replicated WHERE hash = ?", [(block_hash,) for block_hash in under_replicated])
+            self.db.executemany("INSERT OR IGNORE INTO under_replicated VALUES (?)", [(block_hash,) for block_hash in failed])
+            self.db.commit()
+        return moved, failed
+
+
+class Journal:
+    def __init__(self, path=JOURNAL_FILE, synced_files=()):
+        # Write-ahead log of multi-step operations: a begin record before the first step, a commit record after the last.
+        # Commits are group committed: one thread fsyncs the files written since the last commit, the given
+        # database WAL files and the journal for every operation waiting, then wakes them all
+        self.path = path
+        self.synced_files = synced_files
+        self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT)
+        if fcntl is not None:
+            # Held until close: another process would take this one's open marker for a crash and "recover" under it
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(self.fd)
+                raise RuntimeError(f"The storage folder is in use by another process ('{path}' is locked).") from None
+        self.records = []
+        if os.path.exists(path):
+            with open(path, "rb") as file:
+                for line in file:
+                    try:
+                        self.records.append(json.loads(line))
+                    except ValueError:
+                        break  # Torn write at the end of the log
+        self.condition = threading.Condition()
+        self.ids = itertools.count(max((record.get("id", 0) for record in self.records), default=0) + 1)
+        self.open_records = {}
+        self.pending_paths = set()
+        self.queued_commits = []
+        self.tickets = 0
+        self.synced = 0
+        self.syncing = False
+        self.finished = 0
+
+    def begin(self, op, **fields):
+        # Log the start of an operation; the record reaches disk with the next group commit
+        with self.condition:
+            record = dict(fields, id=next(self.ids), op=op)
+            self.open_records[record["id"]] = record
+            os.write(self.fd, json.dumps(record).encode() + b"\n")
+        return record["id"]
+
+    def track(self, path):
+        # A file that has to be on disk before the next commit
+        with self.condition:
+            self.pending_paths.add(path)
+
+    def abort(self, record_id):
+        # Recovery rolls back operations without a commit record
+        with self.condition:
+            self.open_records.pop(record_id, None)
+
+    def commit(self, record_id):
+        # Return once the operation's files and its commit record are on disk
+        with self.condition:
+            self.open_records.pop(record_id, None)
+            self.queued_commits.append(record_id)
+            self.tickets += 1
+            ticket = self.tickets
+            while self.synced < ticket:
+                if self.syncing:
+                    self.condition.wait()
+                    continue
+                # Lead a group commit for every operation queued so far
+                self.syncing = True
+                paths, self.pending_paths = self.pending_paths, set()
+                commits, self.queued_commits = self.queued_commits, []
+                target = self.tickets
+                self.condition.release()
+                try:
+                    for path in paths:
+                        fsync_path(path)
+                    for folder in {os.path.dirname(path) or "." for path in paths}:
+                        fsync_path(folder)
+                    for path in self.synced_files:
+                        fsync_path(path)
+                    os.write(self.fd, b"".join(json.dumps({"id": commit, "commit": True}).encode() + b"\n" for commit in commits))
+                    os.fsync(self.fd)
+                except BaseException:
+                    with self.condition:
+                        self.pending_paths |= paths
+                        self.queued_commits = commits + self.queued_commits
+                    raise
+                finally:
+                    self.condition.acquire()
+                    self.syncing = False
+                    self.condition.notify_all()
+                self.synced = target
+                self.finished += len(commits)
+
+    def reset(self, records=()):
+        # Truncate the log to the given records plus the operations still in flight
+        with self.condition:
+            while self.syncing:
+                self.condition.wait()
+            os.ftruncate(self.fd, 0)
+            os.write(self.fd, b"".join(json.dumps(record).encode() + b"\n" for record in list(records) + list(self.open_records.values())))
+            os.fsync(self.fd)
+            self.records = []
+            self.finished = 0
+
+    def close(self):
+        os.close(self.fd)
+
+
+class MetadataIndex:
+    def __init__(self, path=METADATA_INDEX_FILE):
+        # Persistent index of files and versions so lookups and listings never touch the upload folders
+        self.lock = threading.Lock()
+        self.created = not os.path.exists(path)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        # Commits are made durable by the journal's group commit fsyncing the WAL file
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS files (name TEXT PRIMARY KEY, size INTEGER, mtime REAL, sha256 TEXT, location TEXT)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS versions (name TEXT, version_id TEXT, created REAL, location TEXT, size INTEGER, depth INTEGER DEFAULT 0, PRIMARY KEY (name, version_id))")
+        # Indexes created before delta versions lack the size and chain depth columns
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(versions)")]
+        if "size" not in columns:
+            self.db.execute("ALTER TABLE versions ADD COLUMN size INTEGER")
+            self.db.execute("ALTER TABLE versions ADD COLUMN depth INTEGER DEFAULT 0")
+        self.db.commit()
+
+    def get(self, file_name):
+        # Return the metadata of a file, or None if it isn't indexed
+        with self.lock:
+            row = self.db.execute("SELECT name, size, mtime, sha256, location FROM files WHERE name = ?", (file_name,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(("name", "size", "mtime", "sha256", "location"), row))
+
+    def put(self, file_name, size, mtime, sha256, location):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", (file_name, size, mtime, sha256, location))
+            self.db.commit()
+
+    def delete(self, file_name):
+        with self.lock:
+            self.db.execute("DELETE FROM files WHERE name = ?", (file_name,))
+            self.db.commit()
+
+    def list(self, prefix="", limit=None, after=None):
+        # List file names in order, filtered by prefix; pass the last name of a page as after to get the next one
+        query = "SELECT name FROM files WHERE name >= ?"
+        params = [prefix]
+        if prefix:
+            # Names starting with prefix sort below prefix followed by the highest code point
+            query += " AND name < ?"
+            params.append(prefix + "\U0010ffff")
+        if after is not None:
+            query += " AND name > ?"
+            params.append(after)
+        query += " ORDER BY name"
+        if limit is not None:
+            query += " LIMIT ?"
+            params.append(limit)
+        with self.lock:
+            return [name for (name,) in self.db.execute(query, params)]
+
+    def count(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def add_version(self, file_name, version_id, created, location, size, depth):
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO versions (name, version_id, created, location, size, depth) VALUES (?, ?, ?, ?, ?, ?)", (file_name, version_id, created, location, size, depth))
+            self.db.commit()
+
+    def get_version(self, file_name, version_id):
+        with self.lock:
+            row = self.db.execute("SELECT version_id, created, location, size, depth FROM versions WHERE name = ? AND version_id = ?", (file_name, version_id)).fetchone()
+        return None if row is None else dict(zip(("version_id", "created", "location", "size", "depth"), row))
+
+    def versioned(self):
+        # Names with versions, including removed files whose versions are kept
+        with self.lock:
+            return [name for (name,) in self.db.execute("SELECT DISTINCT name FROM versions")]
+
+    def list_versions(self, file_name):
+        # Versions of a file, oldest first
+        with self.lock:
+            rows = self.db.execute("SELECT version_id, created, location, size, depth FROM versions WHERE name = ? ORDER BY created", (file_name,)).fetchall()
+        return [dict(zip(("version_id", "created", "location", "size", "depth"), row)) for row in rows]
+
+    def rebuild(self, server):
+        # Recreate the index by scanning the manifests, versions and any unmigrated uploads folders
+        files = {}
+        for entry in os.scandir(MANIFESTS_FOLDER):
+            if entry.name.endswith(MANIFEST_SUFFIX):
+                manifest = server.load_manifest(entry.path)
+                name = entry.name[:-len(MANIFEST_SUFFIX)]
+                files[name] = (name, manifest["size"], entry.stat().st_mtime, manifest["sha256"], entry.path)
+        if os.path.isdir(UPLOADS_FOLDER):
+            # Plaintext copies written before encrypted-at-rest storage; python code.py migrate converts them
+            for entry in os.scandir(UPLOADS_FOLDER):
+                if not entry.is_file() or entry.name in files:
+                    continue
+                with open(entry.path, "rb") as file:
+                    sha256 = server.hash_file(file)
+                encrypted_file_path = os.path.join(ENCRYPTED_FOLDER, entry.name)
+                location = encrypted_file_path if os.path.exists(encrypted_file_path) else None
+                stat = entry.stat()
+                files[entry.name] = (entry.name, stat.st_size, stat.st_mtime, sha256, location)
+        versions = []
+        for folder in os.scandir(VERSIONS_FOLDER):
+            if not folder.is_dir():
+                continue
+            for entry in os.scandir(folder.path):
+                version_id, suffix = os.path.splitext(entry.name)
+                if suffix in (MANIFEST_SUFFIX, DELTA_SUFFIX):
+                    manifest = server.load_manifest(entry.path)
+                    versions.append((folder.name, version_id, manifest.get("created", entry.stat().st_mtime), entry.path, manifest["size"], manifest.get("depth", 0)))
+                else:
+                    # Full copies written before the block store
+                    versions.append((folder.name, entry.name, entry.stat().st_mtime, entry.path, entry.stat().st_size, 0))
+        with self.lock:
+            self.db.execute("DELETE FROM files")
+            self.db.execute("DELETE FROM versions")
+            self.db.executemany("INSERT INTO files VALUES (?, ?, ?, ?, ?)", files.values())
+            self.db.executemany("INSERT OR REPLACE INTO versions (name, version_id, created, location, size, depth) VALUES (?, ?, ?, ?, ?, ?)", versions)
+            self.db.commit()
+        return len(files), len(versions)
+
+
+class Metrics:
+    def __init__(self, enabled=True, trace=False):
+        # Counters and histograms keyed by (name, labels); collectors add gauges computed when metrics are rendered
+        self.enabled = enabled
+        self.trace = enabled and trace
+        self.lock = threading.Lock()
+        self.counters = collections.defaultdict(float)
+        self.histograms = {}
+        self.collectors = []
+        self.finished_spans = collections.deque(maxlen=TRACE_SPANS)
+        self.local = threading.local()
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += value
+
+    def observe(self, operation, seconds, bytes_out=0, error=False):
+        # Record one call of an operation
+        with self.lock:
+            histogram = self.histograms.get(operation)
+            if histogram is None:
+                histogram = self.histograms[operation] = {"buckets": [0] * len(METRICS_BUCKETS), "sum": 0.0, "count": 0}
+            index = bisect.bisect_left(METRICS_BUCKETS, seconds)
+            if index < len(METRICS_BUCKETS):
+                histogram["buckets"][index] += 1
+            histogram["sum"] += seconds
+            histogram["count"] += 1
+            if bytes_out:
+                self.counters[("fss_bytes_out_total", (("operation", operation),))] += bytes_out
+            if error:
+                self.counters[("fss_errors_total", (("operation", operation),))] += 1
+
+    def measure_stream(self, operation, start, chunks, span=None):
+        # Wrap a chunk generator so its bytes and the time until it is exhausted are recorded
+        size = 0
+        error = False
+        try:
+            for chunk in chunks:
+                size += len(chunk)
+                yield chunk
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.observe(operation, time.perf_counter() - start, size, error)
+            if span is not None:
+                span["attributes"]["bytes"] = size
+                self.finish_span(span)
+
+    def stage(self, stage, seconds, size):
+        # Time spent in one stage of an operation, such as hashing or encrypting an upload
+        self.count("fss_stage_seconds_total", seconds, stage=stage)
+        self.count("fss_stage_bytes_total", size, stage=stage)
+        if self.trace:
+            self.record_span(stage, time.time() - seconds, seconds, {"bytes": size})
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        # Trace a block of work as a span nested under the current one
+        if not self.trace:
+            yield None
+            return
+        stack = self.local.__dict__.setdefault("stack", [])
+        span = {"name": name, "span_id": os.urandom(8).hex(), "parent_id": stack[-1]["span_id"] if stack else None, "start": time.time(), "attributes": attributes}
+        stack.append(span)
+        try:
+            yield span
+        finally:
+            stack.pop()
+            # Spans of streamed results stay open until the stream is exhausted
+            if not span.pop("open", False):
+                self.finish_span(span)
+
+    def finish_span(self, span):
+        span["seconds"] = time.time() - span["start"]
+        self.finished_spans.append(span)
+
+    def record_span(self, name, start, seconds, attributes):
+        # Add an already measured span under the current one
+        stack = self.local.__dict__.get("stack")
+        self.finished_spans.append({"name": name, "span_id": os.urandom(8).hex(), "parent_id": stack[-1]["span_id"] if stack else None,
+                                    "start": start, "seconds": seconds, "attributes": attributes})
+
+    def spans(self):
+        # Finished spans, oldest first; a span's children finish, and so appear, before it
+        return list(self.finished_spans)
+
+    def render(self):
+        # Prometheus text exposition format
+        lines = []
+        with self.lock:
+            histograms = {operation: dict(histogram, buckets=list(histogram["buckets"])) for operation, histogram in self.histograms.items()}
+            counters = dict(self.counters)
+        if histograms:
+            lines += ["# HELP fss_operation_seconds Latency of server operations.", "# TYPE fss_operation_seconds histogram"]
+            for operation, histogram in sorted(histograms.items()):
+                cumulative = 0
+                for bound, bucket in zip(METRICS_BUCKETS, histogram["buckets"]):
+                    cumulative += bucket
+                    lines.append(f'fss_operation_seconds_bucket{{operation="{operation}",le="{bound}"}} {cumulative}')
+                lines.append(f'fss_operation_seconds_bucket{{operation="{operation}",le="+Inf"}} {histogram["count"]}')
+                lines.append(f'fss_operation_seconds_sum{{operation="{operation}"}} {histogram["sum"]}')
+                lines.append(f'fss_operation_seconds_count{{operation="{operation}"}} {histogram["count"]}')
+        typed = set()
+        for (name, labels), value in sorted(counters.items()):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} counter")
+            label_text = ",".join(f'{key}="{label}"' for key, label in labels)
+            lines.append(f"{name}{{{label_text}}} {value}" if labels else f"{name} {value}")
+        for collect in self.collectors:
+            for name, kind, value in collect():
+                lines += [f"# TYPE {name} {kind}", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+    def write(self, path):
+        # Write the metrics atomically, for node_exporter's textfile collector or a cron job
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "w") as file:
+            file.write(self.render())
+        os.replace(temporary_path, path)
+
+    def write_every(self, path, interval=METRICS_FILE_INTERVAL):
+        # Rewrite the metrics file in a background thread
+        def loop():
+            while True:
+                self.write(path)
+                time.sleep(interval)
+        threading.Thread(target=loop, daemon=True).start()
+
+    def serve(self, port, host=DEFAULT_HOST):
+        # Serve the metrics over HTTP for Prometheus to scrape
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        httpd = http.server.ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        return httpd
+
+
+def metrics_from_environment():
+    # FSS_METRICS_PORT serves metrics over HTTP, FSS_METRICS_FILE rewrites them to a file and FSS_TRACE=1 records spans
+    port = os.environ.get("FSS_METRICS_PORT")
+    path = os.environ.get("FSS_METRICS_FILE")
+    metrics = Metrics(enabled=bool(port or path), trace=os.environ.get("FSS_TRACE") == "1")
+    if port:
+        metrics.serve(int(port))
+    if path:
+        metrics.write_every(path)
+    return metrics
+
+
+def instrumented(operation):
+    # Record the latency, bytes returned and errors of a server method; generators are measured until exhausted
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            metrics = self.metrics
+            if not metrics.enabled:
+                return method(self, *args, **kwargs)
+            start = time.perf_counter()
+            with metrics.span(operation) as span:
+                try:
+                    result = method(self, *args, **kwargs)
+                except Exception:
+                    metrics.observe(operation, time.perf_counter() - start, error=True)
+                    raise
+                streamed = hasattr(result, "__next__")
+                if streamed and span is not None:
+                    span["open"] = True
+            if streamed:
+                return metrics.measure_stream(operation, start, result, span)
+            metrics.observe(operation, time.perf_counter() - start, len(result) if isinstance(result, bytes) else 0)
+            return result
+        return wrapper
+    return decorate
+
+
+class ReadWriteLock:
+    def __init__(self):
+        # Any number of readers or one writer; a waiting writer holds off new readers so it isn't starved
+        self.condition = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = False
+        self.waiting_writers = 0
+
+    @contextlib.contextmanager
+    def reading(self):
+        with self.condition:
+            while self.writer or self.waiting_writers:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if not self.readers:
+                    self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def writing(self):
+        with self.condition:
+            self.waiting_writers += 1
+            while self.writer or self.readers:
+                self.condition.wait()
+            self.waiting_writers -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = False
+                self.condition.notify_all()
+
+
+class FileLocks:
     def __init__(self):
-        # Ensure necessary folders and key file exist, if not, create them
-        if not os.path.exists(UPLOADS_FOLDER):
-            os.makedirs(UPLOADS_FOLDER)
+        # One read-write lock per file name, created on first use and dropped once nobody holds or waits for it
+        self.lock = threading.Lock()
+        self.locks = {}
+
+    @contextlib.contextmanager
+    def hold(self, file_name):
+        with self.lock:
+            entry = self.locks.setdefault(file_name, [ReadWriteLock(), 0])
+            entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.locks[file_name]
+
+    @contextlib.contextmanager
+    def reading(self, file_name):
+        with self.hold(file_name) as lock, lock.reading():
+            yield
+
+    @contextlib.contextmanager
+    def writing(self, file_name):
+        with self.hold(file_name) as lock, lock.writing():
+            yield
+
+
+class FileSharingServer:
+    def __init__(self, cluster_nodes=None, replication_factor=REPLICATION_FACTOR, cache_size=BLOCK_CACHE_SIZE, metrics=None, write_quorum=WRITE_QUORUM):
+        # Locks the storage folder first, so two processes never create keys, recover or rotate in it at once
+        self.journal = Journal(synced_files=(os.path.join(BLOCKS_FOLDER, BLOCK_INDEX_FILE) + "-wal", METADATA_INDEX_FILE + "-wal"))
+        # Ensure necessary folders and key file exist, if not, create them; only ciphertext is stored
         if not os.path.exists(ENCRYPTED_FOLDER):
             os.makedirs(ENCRYPTED_FOLDER)
         if not os.path.exists(VERSIONS_FOLDER):
             os.makedirs(VERSIONS_FOLDER)
+        if not os.path.exists(MANIFESTS_FOLDER):
+            os.makedirs(MANIFESTS_FOLDER)
         if not os.path.exists(KEY_FILE):
-            # Generate a new encryption key if one doesn't exist
-            key = Fernet.generate_key()
-            with open(KEY_FILE, "wb") as key_file:
-                key_file.write(key)
+            # Generate a new master key if one doesn't exist
+            self.save_master_keys([Fernet.generate_key()])
+        # Load the master keys, newest first
+        with open(KEY_FILE, "rb") as key_file:
+            self.keyring = Keyring(key_file.read().split())
+        self.stream_cipher = ChunkedCipher()
+        if cluster_nodes:
+            # Keep encrypted blocks on storage nodes instead of the local blocks folder
+            self.blocks = ClusterBlockStore(self.stream_cipher, self.keyring, cluster_nodes, replication_factor, cache_size=cache_size, journal=self.journal, write_quorum=write_quorum)
         else:
-            # Load encryption key from file
-            with open(KEY_FILE, "rb") as key_file:
-                self.key = key_file.read()
-                self.cipher = Fernet(self.key)
+            self.blocks = BlockStore(self.stream_cipher, self.keyring, cache_size=cache_size, journal=self.journal)
+        # Blobs written before envelope encryption are decrypted with the original master key
+        self.key = self.blocks.legacy_key
+        self.cipher = Fernet(self.key)
+        self.metrics = metrics or Metrics(enabled=False)
+        self.metrics.collectors.append(self.collect_metrics)
+        # Writers of a file take its write lock to publish; readers take the read lock just long enough to pin a snapshot
+        self.locks = FileLocks()
+        self.index = MetadataIndex()
+        if self.index.created:
+            # Index trees created before the metadata index existed
+            self.index.rebuild(self)
+        if self.journal.records:
+            # The last run didn't close cleanly
+            self.recover(self.journal.records)
+        # The marker makes the next start recover unless close() removes it
+        self.journal.reset([{"op": "open"}])
+
+    def recover(self, records):
+        # Undo or finish the operations the journal has no commit for, then recount block references from the manifests.
+        # Committed operations need nothing: their files and index rows were synced before the commit record was written
+        committed = {record["id"] for record in records if record.get("commit")}
+        latest = {record["name"]: record["id"] for record in records if "name" in record}
+        for record in records:
+            if record.get("op") not in ("upload", "version", "migrate", "remove") or record["id"] in committed or latest[record["name"]] != record["id"]:
+                continue
+            if record["op"] == "upload":
+                manifest = self.load_manifest(self.manifest_path(record["name"]))
+                if self.index.get(record["name"]) is None and manifest is not None:
+                    os.remove(self.manifest_path(record["name"]))
+                elif self.index.get(record["name"]) is not None and manifest is None:
+                    self.index.delete(record["name"])
+                elif manifest is not None and self.index.get(record["name"])["sha256"] != manifest["sha256"]:
+                    # A replacement stopped between renaming its manifest into place and updating the index
+                    self.index.put(record["name"], manifest["size"], time.time(), manifest["sha256"], self.manifest_path(record["name"]))
+            elif record["op"] == "version":
+                if self.index.get_version(record["name"], record["version_id"]) is None and os.path.exists(record["location"]):
+                    os.remove(record["location"])
+            elif record["op"] == "migrate":
+                # The old copies are still there, so go back to them; the next migration starts over
+                if os.path.exists(self.manifest_path(record["name"])):
+                    os.remove(self.manifest_path(record["name"]))
+                metadata = record["metadata"]
+                if metadata is None:
+                    self.index.delete(record["name"])
+                else:
+                    self.index.put(record["name"], metadata["size"], metadata["mtime"], metadata["sha256"], metadata["location"])
+            else:
+                # A removal that started is always finished
+                self.delete_file_data(record["name"])
+        # Manifests of uploads whose begin record never reached the disk
+        indexed = set(self.index.list())
+        for entry in os.scandir(MANIFESTS_FOLDER):
+            if entry.name.endswith(TEMPORARY_SUFFIX) or (entry.name.endswith(MANIFEST_SUFFIX) and entry.name[:-len(MANIFEST_SUFFIX)] not in indexed):
+                os.remove(entry.path)
+        counts = collections.Counter()
+        for file_name in indexed:
+            manifest = self.load_manifest(self.manifest_path(file_name))
+            if manifest is not None:
+                counts.update(block_hash for block_hash, _ in manifest["chunks"])
+        # Versions outlive the removal of their file
+        for file_name in self.index.versioned():
+            for version in self.index.list_versions(file_name):
+                version_manifest = self.load_version_manifest(file_name, version["version_id"])
+                if version_manifest is not None:
+                    counts.update(block_hash for block_hash, _ in version_manifest["chunks"])
+        self.blocks.set_refs(counts)
+        self.blocks.collect_garbage()
+        self.blocks.sweep()
+
+    def commit(self, record_id):
+        # Wait for the operation to be durable and keep the journal from growing without bound
+        self.journal.commit(record_id)
+        if self.journal.finished >= JOURNAL_CHECKPOINT_RECORDS:
+            self.checkpoint()
+
+    def checkpoint(self):
+        # Drop finished operations from the journal; everything they wrote is already on disk
+        self.journal.reset([{"op": "open"}])
 
+    def close(self):
+        # A clean shutdown leaves an empty journal, so the next start skips recovery
+        self.journal.reset()
+        self.journal.close()
+
+    def save_master_keys(self, keys):
+        # Replace the key file atomically so a crash never leaves it half written
+        atomic_write(KEY_FILE, [b"\n".join(keys) + b"\n"])
+
+    def rotate_master_key(self):
+        # Add a new master key, rewrap every data key under it and retire the old ones; returns the keys rewrapped.
+        # The old keys stay in the key file until rewrapping is done, so an interrupted rotation can just be run again.
+        # No other process can have the folder open (the journal locks it), since it would keep wrapping under a retired key
+        keys = [Fernet.generate_key()] + self.keyring.keys
+        self.save_master_keys(keys)
+        self.keyring = self.blocks.keyring = Keyring(keys)
+        rewrapped = self.blocks.rewrap()
+        self.save_master_keys(keys[:1])
+        self.keyring = self.blocks.keyring = Keyring(keys[:1])
+        return rewrapped
+
+    @instrumented("encrypt_file")
     def encrypt_file(self, file_name, data):
-        # Encrypt file data and save it to the encrypted folder
-        encrypted_data = self.cipher.encrypt(data)
+        # Encrypt file data (bytes or a binary file object) chunk by chunk into the encrypted folder under a new data key
+        check_file_name(file_name)
         encrypted_file_path = os.path.join(ENCRYPTED_FOLDER, file_name)
-        with open(encrypted_file_path, "wb") as file:
-            file.write(encrypted_data)
+        data_key = os.urandom(DATA_KEY_SIZE)
+        atomic_write(encrypted_file_path, self.stream_cipher.encrypt_stream(iter_buffers(data), data_key))
+        self.blocks.set_named_key(encrypted_file_path, data_key)
         return encrypted_file_path
 
+    def store_blocks(self, data, chunk_sizes=None):
+        # Read data once, feeding the file hash and the chunker from the same buffers;
+        # chunk_sizes from plan_chunks skips finding the boundaries again
+        hash_object = hashlib.sha256()
+        chunks = []
+        size = 0
+        timed = self.metrics.enabled
+        timings = {"hash": 0.0, "encrypt": 0.0}
+        start = time.perf_counter()
+
+        def tee():
+            for view in iter_buffers(data):
+                if timed:
+                    hash_start = time.perf_counter()
+                    hash_object.update(view)
+                    timings["hash"] += time.perf_counter() - hash_start
+                else:
+                    hash_object.update(view)
+                yield view
+
+        codec = None
+        try:
+            for chunk in (cdc_chunks(tee()) if chunk_sizes is None else planned_chunks(tee(), chunk_sizes)):
+                if codec is None:
+                    # Choose the codec for the whole file from its first chunk
+                    codec = choose_codec(chunk)
+                if timed:
+                    hash_start = time.perf_counter()
+                    block_hash = self.blocks.block_id(chunk)
+                    encrypt_start = time.perf_counter()
+                    self.blocks.put(block_hash, chunk, codec)
+                    timings["hash"] += encrypt_start - hash_start
+                    timings["encrypt"] += time.perf_counter() - encrypt_start
+                else:
+                    block_hash = self.blocks.block_id(chunk)
+                    self.blocks.put(block_hash, chunk, codec)
+                chunks.append([block_hash, len(chunk)])
+                size += len(chunk)
+        except Exception:
+            # Release the blocks stored so far if reading or storing fails part way, e.g. a cancelled upload
+            self.blocks.add_refs((block_hash for block_hash, _ in chunks), -1)
+            self.blocks.collect_garbage()
+            raise
+        if timed:
+            # Reading and finding chunk boundaries is whatever hashing and encrypting didn't take
+            self.metrics.stage("hash", timings["hash"], size)
+            self.metrics.stage("encrypt", timings["encrypt"], size)
+            self.metrics.stage("read_and_chunk", time.perf_counter() - start - timings["hash"] - timings["encrypt"], size)
+        return {"size": size, "sha256": hash_object.hexdigest(), "chunks": chunks}
+
+    def compression_stats(self):
+        # Compression achieved and its CPU cost so far
+        stats = dict(self.stream_cipher.compression_stats)
+        stats["ratio"] = stats["bytes_out"] / stats["bytes_in"] if stats["bytes_in"] else 1.0
+        stats["mb_per_second"] = stats["bytes_in"] / 1024 / 1024 / stats["seconds"] if stats["seconds"] else 0.0
+        return stats
+
+    def collect_metrics(self):
+        # Gauges for cache, deduplication and compression, computed when metrics are rendered
+        cache = self.cache_stats()
+        blocks = self.blocks.stats()
+        compression = self.compression_stats()
+        return [
+            ("fss_cache_hits_total", "counter", cache["hits"]),
+            ("fss_cache_misses_total", "counter", cache["misses"]),
+            ("fss_cache_evictions_total", "counter", cache["evictions"]),
+            ("fss_cache_bytes", "gauge", cache["bytes"]),
+            ("fss_cache_hit_ratio", "gauge", cache["hit_ratio"]),
+            ("fss_logical_bytes", "gauge", blocks["logical_bytes"]),
+            ("fss_stored_bytes", "gauge", blocks["stored_bytes"]),
+            ("fss_unique_bytes", "gauge", blocks["unique_bytes"]),
+            # Both sides are plaintext, so compression only shows up in fss_compression_ratio
+            ("fss_dedup_ratio", "gauge", blocks["logical_bytes"] / blocks["unique_bytes"] if blocks["unique_bytes"] else 1.0),
+            ("fss_compression_ratio", "gauge", compression["ratio"]),
+        ]
+
+    def cache_stats(self):
+        # Hits, misses, evictions and size of the decrypted block cache
+        return self.blocks.cache.stats()
+
+    def write_manifest(self, manifest_path, manifest):
+        # Synced by the journal's next group commit
+        atomic_write(manifest_path, [json.dumps(manifest).encode()], self.journal)
+
+    def load_manifest(self, manifest_path):
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path) as file:
+            return json.load(file)
+
+    def manifest_path(self, file_name):
+        return os.path.join(MANIFESTS_FOLDER, file_name + MANIFEST_SUFFIX)
+
+    def iter_manifest(self, manifest):
+        # Yield the plaintext of every chunk listed in a manifest
+        for block_hash, _ in manifest["chunks"]:
+            yield self.blocks.get(block_hash)
+
+    def iter_pinned(self, chunks, read):
+        # Yield read(block_hash) for chunks pinned under a file's read lock, unpinning them when done or closed
+        try:
+            for block_hash, _ in chunks:
+                yield read(block_hash)
+        finally:
+            self.blocks.unpin(block_hash for block_hash, _ in chunks)
+
+    def iter_encrypted(self, file_name):
+        # Yield the stored ciphertext of a file
+        check_file_name(file_name)
+        with self.locks.reading(file_name):
+            if self.index.get(file_name) is None:
+                return
+            manifest = self.load_manifest(self.manifest_path(file_name))
+            if manifest is None:
+                file = open(os.path.join(ENCRYPTED_FOLDER, file_name), "rb")
+            else:
+                self.blocks.pin(block_hash for block_hash, _ in manifest["chunks"])
+        if manifest is not None:
+            yield from self.iter_pinned(manifest["chunks"], self.blocks.read_blob)
+            return
+        with file:
+            yield from iter_chunks(file)
+
+    def pin_content(self, file_name, standalone=False):
+        # Under the file's read lock, pin the blocks of its current content or open its legacy blob, so writers
+        # replacing or removing it afterwards don't affect this read. Returns (manifest, file, data_key), or None
+        # if the file doesn't exist; with standalone, an unindexed blob written by encrypt_file is read too
+        check_file_name(file_name)
+        with self.locks.reading(file_name):
+            encrypted_file_path = os.path.join(ENCRYPTED_FOLDER, file_name)
+            if self.index.get(file_name) is None:
+                if standalone and os.path.exists(encrypted_file_path):
+                    return None, open(encrypted_file_path, "rb"), self.blocks.named_key(encrypted_file_path) or self.blocks.legacy_stream_key
+                return None
+            manifest = self.load_manifest(self.manifest_path(file_name))
+            if manifest is not None:
+                self.blocks.pin(block_hash for block_hash, _ in manifest["chunks"])
+                return manifest, None, None
+            # Files stored before the block store; an open file stays readable if a writer deletes it
+            if os.path.exists(encrypted_file_path):
+                return None, open(encrypted_file_path, "rb"), self.blocks.named_key(encrypted_file_path) or self.blocks.legacy_stream_key
+            # Unmigrated plaintext copy that never had an encrypted blob
+            return None, open(os.path.join(UPLOADS_FOLDER, file_name), "rb"), None
+
+    def open_content(self, content, chunks=None):
+        # Decrypted data of content from pin_content (only the given chunks of its manifest, if any).
+        # The generator is started before it is returned, so closing or dropping it unpins or closes
+        # the content even if it is never read
+        def read():
+            manifest, file, data_key = content
+            try:
+                yield
+                if manifest is not None:
+                    for block_hash, _ in manifest["chunks"] if chunks is None else chunks:
+                        yield self.blocks.get(block_hash)
+                elif data_key is None:
+                    yield from iter_chunks(file)
+                elif file.read(len(STREAM_MAGIC)) != STREAM_MAGIC:
+                    # Blobs written before the streaming format are single Fernet tokens
+                    file.seek(0)
+                    yield self.cipher.decrypt(file.read())
+                else:
+                    file.seek(0)
+                    yield from self.stream_cipher.decrypt_stream(file, data_key)
+            finally:
+                if manifest is not None:
+                    self.blocks.unpin(block_hash for block_hash, _ in manifest["chunks"])
+                else:
+                    file.close()
+
+        blocks = read()
+        next(blocks)
+        return blocks
+
+    def iter_decrypt_file(self, file_name):
+        # Decrypted file data chunk by chunk from the content the file had when this was called;
+        # returns None if the file doesn't exist
+        content = self.pin_content(file_name, standalone=True)
+        return None if content is None else self.open_content(content)
+
+    @instrumented("decrypt_file")
     def decrypt_file(self, file_name):
         # Decrypt file data
-        encrypted_file_path = os.path.join(ENCRYPTED_FOLDER, file_name)
-        with open(encrypted_file_path, "rb") as file:
-            encrypted_data = file.read()
-        decrypted_data = self.cipher.decrypt(encrypted_data)
-        return decrypted_data
+        chunks = self.iter_decrypt_file(file_name)
+        return None if chunks is None else b"".join(chunks)
 
+    @instrumented("hash_file")
     def hash_file(self, data):
-        # Generate SHA256 hash of file data
+        # Generate SHA256 hash of file data (bytes or a binary file object)
         hash_object = hashlib.sha256()
-        hash_object.update(data)
+        for chunk in iter_chunks(data):
+            hash_object.update(chunk)
         return hash_object.hexdigest()
 
-    def upload_file(self, file_name, data, show_encryption_process=False):
-        # Upload a file to the server
-        file_path = os.path.join(UPLOADS_FOLDER, file_name)
-        if os.path.exists(file_path):
-            return None  # File already exists
-        with open(file_path, "wb") as file:
-            file.write(data)
+    def upload_allowed(self, file_name, if_match):
+        # New files only, unless if_match is the SHA256 an existing file must still have to be replaced
+        metadata = self.index.get(file_name)
+        if if_match is None:
+            return metadata is None
+        return metadata is not None and metadata["sha256"] == if_match
+
+    @instrumented("upload_file")
+    def upload_file(self, file_name, data, show_encryption_process=False, chunk_sizes=None, if_match=None):
+        # Upload a file (bytes or a binary file object) to the server; only the encrypted blocks are stored.
+        # Returns None if the file already exists or, with if_match, if it changed since the caller read it
+        check_file_name(file_name)
+        if not self.upload_allowed(file_name, if_match):
+            return None  # Checked again before publishing; this only saves storing blocks for nothing
         if show_encryption_process:
             # Show encryption process if requested
             print("Starting encryption process...")
             print("Step 1: Reading file content.")
-            print("Step 2: Encrypting file content.")
-        encrypted_file_path = self.encrypt_file(file_name, data)
+            print("Step 2: Hashing and encrypting file content in one pass.")
+        created = time.time()
+        # Blocks are stored without holding the file's lock; only publishing the manifest is serialized.
+        # Blocks of an upload that never publishes are released on failure, or by recovery after a crash
+        manifest = self.store_blocks(data, chunk_sizes=chunk_sizes)
+        with self.locks.writing(file_name):
+            if not self.upload_allowed(file_name, if_match):
+                # Another upload of the same name got there first
+                self.blocks.add_refs((block_hash for block_hash, _ in manifest["chunks"]), -1)
+                self.blocks.collect_garbage()
+                self.metrics.count("fss_upload_conflicts_total")
+                return None
+            replaced = self.index.get(file_name) is not None
+            previous = self.load_manifest(self.manifest_path(file_name))
+            record_id = self.journal.begin("upload", name=file_name)
+            try:
+                self.write_manifest(self.manifest_path(file_name), manifest)
+                self.index.put(file_name, manifest["size"], created, manifest["sha256"], self.manifest_path(file_name))
+            except Exception:
+                self.journal.abort(record_id)
+                raise
+            self.commit(record_id)
+        if replaced:
+            # Readers still streaming the old content have its blocks pinned
+            self.release_file_data(file_name, previous)
+        self.metrics.count("fss_bytes_in_total", manifest["size"], operation="upload_file")
         return file_name
 
     def download_file(self, file_name):
         # Download a file from the server
-        file_path = os.path.join(UPLOADS_FOLDER, file_name)
-        if os.path.exists(file_path):
-            with open(file_path, "rb") as file:
-                return file.read()
-        else:
+        chunks = self.iter_download_file(file_name)
+        return None if chunks is None else b"".join(chunks)
+
+    @instrumented("download_file")
+    def iter_download_file(self, file_name):
+        # Download a file from the server chunk by chunk, decrypting as it goes; returns None if it doesn't exist
+        content = self.pin_content(file_name)
+        return None if content is None else self.open_content(content)
+
+    @instrumented("stat_file")
+    def stat_file(self, file_name):
+        # Return the size and SHA256 of a file, or None if it doesn't exist
+        metadata = self.index.get(file_name)
+        if metadata is None:
             return None
+        return {"size": metadata["size"], "sha256": metadata["sha256"]}
 
-    def list_files(self):
-        # List all files available on the server
-        return os.listdir(UPLOADS_FOLDER)
+    @instrumented("read_range")
+    def iter_range(self, file_name, offset, length):
+        # Yield up to length bytes of a file starting at offset; returns None if it doesn't exist
+        content = self.pin_content(file_name)
+        if content is None:
+            return None
+        end = offset + length
+        manifest = content[0]
+        if manifest is not None:
+            # Only the blocks overlapping the range are fetched and decrypted
+            ends = list(itertools.accumulate(size for _, size in manifest["chunks"]))
+            position = bisect.bisect_right(ends, offset)
+            start = ends[position - 1] if position else 0
+            blocks = self.open_content(content, manifest["chunks"][position:bisect.bisect_left(ends, end) + 1])
+        else:
+            # Legacy blobs can only be decrypted from the start
+            start = 0
+            blocks = self.open_content(content)
 
+        def read_range(start):
+            with contextlib.closing(blocks):
+                if length <= 0:
+                    # Nothing to read, not an empty slice of the first block
+                    return
+                for block in blocks:
+                    if start >= end:
+                        break
+                    if start + len(block) > offset:
+                        yield block[max(0, offset - start):end - start]
+                    start += len(block)
+        return read_range(start)
+
+    def read_range(self, file_name, offset, length):
+        # Read a byte range of a file
+        chunks = self.iter_range(file_name, offset, length)
+        return None if chunks is None else b"".join(chunks)
+
+    @instrumented("list_files")
+    def list_files(self, prefix="", limit=None, after=None):
+        # List files available on the server, optionally filtered by prefix and paginated
+        return self.index.list(prefix, limit, after)
+
+    def rebuild_index(self):
+        # Rebuild the metadata index from the manifests and versions folders
+        return self.index.rebuild(self)
+
+    @instrumented("create_version")
     def create_version(self, file_name):
-        # Create a version of the file
+        # Create a version of the file as a manifest sharing the file's chunks; the write lock keeps the file
+        # from changing underneath and orders concurrent versions of it
+        check_file_name(file_name)
+        with self.locks.writing(file_name):
+            if self.index.get(file_name) is not None:
+                manifest = self.load_manifest(self.manifest_path(file_name))
+                if manifest is None:
+                    # Files uploaded before the block store are chunked on first use
+                    manifest = self.migrate_file(file_name)
+                hash_value = manifest["sha256"]
+                if self.index.get_version(file_name, hash_value) is None:
+                    version_folder = os.path.join(VERSIONS_FOLDER, file_name)
+                    if not os.path.exists(version_folder):
+                        os.makedirs(version_folder)
+                    created = time.time()
+                    versions = self.index.list_versions(file_name)
+                    previous = versions[-1] if versions else None
+                    if previous is not None and previous["location"].endswith((MANIFEST_SUFFIX, DELTA_SUFFIX)) and previous["depth"] + 1 < VERSION_SNAPSHOT_INTERVAL:
+                        # Store only how this version differs from the previous one
+                        base = self.load_version_manifest(file_name, previous["version_id"])
+                        depth = previous["depth"] + 1
+                        version = {"base": previous["version_id"], "size": manifest["size"], "sha256": hash_value, "created": created, "depth": depth,
+                                   "ops": diff_chunks(base["chunks"], manifest["chunks"])}
+                        version_file_path = os.path.join(version_folder, hash_value + DELTA_SUFFIX)
+                    else:
+                        # Start a new chain with a full snapshot so reconstruction never applies more than the interval's deltas
+                        depth = 0
+                        version = dict(manifest, created=created)
+                        version_file_path = os.path.join(version_folder, hash_value + MANIFEST_SUFFIX)
+                    record_id = self.journal.begin("version", name=file_name, version_id=hash_value, location=version_file_path)
+                    try:
+                        # A version keeps all of its chunks alive whether it is stored as a snapshot or a delta
+                        self.blocks.add_refs(block_hash for block_hash, _ in manifest["chunks"])
+                        self.write_manifest(version_file_path, version)
+                        self.index.add_version(file_name, hash_value, created, version_file_path, manifest["size"], depth)
+                    except Exception:
+                        self.journal.abort(record_id)
+                        raise
+                    self.commit(record_id)
+                    return True
+        return False
+
+    def list_versions(self, file_name):
+        # List the versions of a file, oldest first
+        return [{"version_id": version["version_id"], "created": version["created"], "size": version["size"]} for version in self.index.list_versions(file_name)]
+
+    def load_version_manifest(self, file_name, version_id):
+        # Rebuild the chunk manifest of a version from its snapshot and the deltas after it
+        version = self.index.get_version(file_name, version_id)
+        if version is None or not version["location"].endswith((MANIFEST_SUFFIX, DELTA_SUFFIX)):
+            return None
+        manifest = self.load_manifest(version["location"])
+        if version["location"].endswith(DELTA_SUFFIX):
+            base = self.load_version_manifest(file_name, manifest["base"])
+            manifest = {"size": manifest["size"], "sha256": manifest["sha256"], "chunks": apply_chunk_delta(base["chunks"], manifest["ops"])}
+        return manifest
+
+    @instrumented("get_version")
+    def get_version(self, file_name, version_id):
+        # Yield the content of a version chunk by chunk; returns None if it doesn't exist
+        version = self.index.get_version(file_name, version_id)
+        if version is None:
+            return None
+        manifest = self.load_version_manifest(file_name, version_id)
+        if manifest is not None:
+            return self.iter_manifest(manifest)
+
+        def read_copy():
+            # Versions stored as full copies by earlier releases
+            with open(version["location"], "rb") as file:
+                yield from iter_chunks(file)
+        return read_copy()
+
+    def migrate_file(self, file_name):
+        # Move a file's plaintext copy from the uploads folder into encrypted blocks and delete the copy.
+        # The copy and any whole-file blob are only deleted once the blocks, manifest and index row are committed
         file_path = os.path.join(UPLOADS_FOLDER, file_name)
-        if os.path.exists(file_path):
+        metadata = self.index.get(file_name)
+        manifest = self.load_manifest(self.manifest_path(file_name))
+        if manifest is None:
             with open(file_path, "rb") as file:
-                data = file.read()
-            hash_value = self.hash_file(data)
-            version_folder = os.path.join(VERSIONS_FOLDER, file_name)
-            if not os.path.exists(version_folder):
-                os.makedirs(version_folder)
-            version_file_path = os.path.join(version_folder, hash_value)
-            if not os.path.exists(version_file_path):
-                shutil.copy(file_path, version_file_path)
-                return True
-        return False
+                manifest = self.store_blocks(file)
+            record_id = self.journal.begin("migrate", name=file_name, metadata=metadata)
+            try:
+                self.write_manifest(self.manifest_path(file_name), manifest)
+                mtime = metadata["mtime"] if metadata is not None else os.path.getmtime(file_path)
+                self.index.put(file_name, manifest["size"], mtime, manifest["sha256"], self.manifest_path(file_name))
+            except Exception:
+                self.journal.abort(record_id)
+                raise
+            self.commit(record_id)
+        # The old copies are superseded by the blocks
+        self.release_file_data(file_name, None)
+        return manifest
 
+    def migrate_uploads(self):
+        # Convert a plaintext uploads folder written by earlier releases to encrypted-only storage, one file at a time
+        if not os.path.isdir(UPLOADS_FOLDER):
+            return 0
+        migrated = 0
+        for entry in os.scandir(UPLOADS_FOLDER):
+            if entry.is_file():
+                with self.locks.writing(entry.name):
+                    self.migrate_file(entry.name)
+                migrated += 1
+        if not os.listdir(UPLOADS_FOLDER):
+            os.rmdir(UPLOADS_FOLDER)
+        return migrated
+
+    @instrumented("remove_file")
     def remove_file(self, file_name):
-        # Remove a file from the server
-        file_path = os.path.join(UPLOADS_FOLDER, file_name)
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            return True
-        else:
-            return False
+        # Remove a file from the server and release chunks no longer referenced
+        check_file_name(file_name)
+        with self.locks.writing(file_name):
+            if self.index.get(file_name) is not None:
+                record_id = self.journal.begin("remove", name=file_name)
+                self.delete_file_data(file_name)
+                self.commit(record_id)
+                return True
+            else:
+                return False
+
+    def delete_file_data(self, file_name):
+        # Delete a file's index entry, manifest and any copies kept by earlier releases; safe to repeat after a crash
+        self.index.delete(file_name)
+        manifest = self.load_manifest(self.manifest_path(file_name))
+        if manifest is not None:
+            os.remove(self.manifest_path(file_name))
+        self.release_file_data(file_name, manifest)
+
+    def release_file_data(self, file_name, manifest):
+        # Delete copies kept by earlier releases and the references of a manifest that is no longer the file's content
+        for legacy_path in (os.path.join(UPLOADS_FOLDER, file_name), os.path.join(ENCRYPTED_FOLDER, file_name)):
+            if os.path.exists(legacy_path):
+                # Unmigrated plaintext copy or whole-file ciphertext
+                os.remove(legacy_path)
+        self.blocks.delete_named_key(os.path.join(ENCRYPTED_FOLDER, file_name))
+        if manifest is not None:
+            self.blocks.add_refs((block_hash for block_hash, _ in manifest["chunks"]), -1)
+            self.blocks.collect_garbage()
+
+
+class DownloadProgress:
+    def __init__(self, file_path, size, sha256):
+        # Preallocate file_path + ".part" and track finished ranges in a progress file next to it
+        self.file_path = file_path
+        self.partial_path = file_path + PARTIAL_SUFFIX
+        self.progress_path = self.partial_path + PROGRESS_SUFFIX
+        self.size = size
+        self.sha256 = sha256
+        self.lock = threading.Lock()
+        done = []
+        if os.path.exists(self.progress_path) and os.path.exists(self.partial_path):
+            with open(self.progress_path) as file:
+                progress = json.load(file)
+            # Only resume if the server still has the same content
+            if progress["size"] == size and progress["sha256"] == sha256:
+                done = progress["done"]
+        if not done:
+            with open(self.partial_path, "wb") as file:
+                file.truncate(size)
+        self.done = set(done)
+        self.file = open(self.partial_path, "r+b")
+        self.pending = [(offset, min(RANGE_SIZE, size - offset)) for offset in range(0, size, RANGE_SIZE) if offset not in self.done]
+
+    def write(self, offset, data):
+        with self.lock:
+            self.file.seek(offset)
+            self.file.write(data)
+
+    def complete(self, offset):
+        # Record a finished range only once its bytes are on disk
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.done.add(offset)
+            with open(self.progress_path + ".tmp", "w") as file:
+                json.dump({"size": self.size, "sha256": self.sha256, "done": sorted(self.done)}, file)
+            os.replace(self.progress_path + ".tmp", self.progress_path)
+
+    def close(self):
+        self.file.close()
+
+    def finish(self):
+        # Verify the whole file against the server's hash and move it into place
+        self.close()
+        hash_object = hashlib.sha256()
+        with open(self.partial_path, "rb") as file:
+            for chunk in iter_chunks(file):
+                hash_object.update(chunk)
+        if os.path.exists(self.progress_path):
+            os.remove(self.progress_path)
+        if hash_object.hexdigest() != self.sha256:
+            os.remove(self.partial_path)
+            return None
+        os.replace(self.partial_path, self.file_path)
+        return self.file_path
 
 
 class FileSharingClient:
     def __init__(self, server):
         self.server = server
 
-    def upload_file(self, file_path):
-        # Upload a file to the server
-        show_encryption_process = input("Do you want to see the encryption process? (yes/no): ").strip().lower() == 'yes'
+    def upload_file(self, file_path, show_encryption_process=None):
+        # Upload a file to the server, asking whether to show the encryption process unless told
+        if show_encryption_process is None:
+            show_encryption_process = input("Do you want to see the encryption process? (yes/no): ").strip().lower() == 'yes'
         if not os.path.exists(file_path):
             print(f"File '{file_path}' not found.")
             return None
         file_name = os.path.basename(file_path)
         with open(file_path, "rb") as file:
-            data = file.read()
-        uploaded_file_name = self.server.upload_file(file_name, data, show_encryption_process=show_encryption_process)
+            uploaded_file_name = self.server.upload_file(file_name, file, show_encryption_process=show_encryption_process)
         if uploaded_file_name:
             return uploaded_file_name
         else:
             print("File upload failed: File already exists on the server.")
             return None
 
-    def download_file(self, file_name, destination_folder):
-        # Download a file from the server
+    def download_file(self, file_name, destination_folder, streams=DOWNLOAD_STREAMS):
+        # Download a file from the server in ranges over several streams, resuming an interrupted download
         while not os.path.exists(destination_folder):
             print("Destination folder does not exist.")
             destination_folder = input("Enter the destination folder path to save the downloaded file: ")
         if file_name:
-            data = self.server.download_file(file_name)
-            if data:
-                file_path = os.path.join(destination_folder, file_name)
-                with open(file_path, "wb") as file:
-                    file.write(data)
+            stat = self.server.stat_file(file_name)
+            if stat:
+                file_path = self.fetch_file(file_name, destination_folder, stat, streams)
+                if file_path is None:
+                    print(f"File '{file_name}' failed verification and was discarded.")
                 return file_path
             else:
                 print(f"File '{file_name}' not found on the server.")
@@ -145,32 +2214,617 @@ class FileSharingClient:
             print("File name not provided.")
             return None
 
-    def list_files(self):
-        # List all files available on the server
-        return self.server.list_files()
+    def fetch_file(self, file_name, destination_folder, stat, streams=DOWNLOAD_STREAMS):
+        # Download a file with the given size and SHA256 into an existing folder without prompting;
+        # returns its path, or None if the result failed verification
+        progress = DownloadProgress(os.path.join(destination_folder, file_name), stat["size"], stat["sha256"])
+        try:
+            with concurrent.futures.ThreadPoolExecutor(streams) as executor:
+                for _ in executor.map(lambda piece: self.download_range(file_name, progress, *piece), progress.pending):
+                    pass
+        finally:
+            progress.close()
+        return progress.finish()
+
+    def download_range(self, file_name, progress, offset, length):
+        # Fetch one range chunk by chunk into the partial file
+        position = offset
+        for chunk in self.server.iter_range(file_name, offset, length) or ():
+            progress.write(position, chunk)
+            position += len(chunk)
+        if position - offset != length:
+            raise IOError(f"Range at {offset} of '{file_name}' ended early.")
+        progress.complete(offset)
+
+    def upload_many(self, file_paths, replace=False, workers=None, io_workers=BATCH_IO_WORKERS):
+        # Upload many files without prompting and return one result per path, in order.
+        # Files whose content already matches the server are skipped; with replace, changed files are
+        # versioned and then replaced, otherwise they are reported as existing.
+        results = [None] * len(file_paths)
+        # Bound the files in flight so a huge batch doesn't queue every file's buffers at once
+        in_flight = threading.BoundedSemaphore((workers or os.cpu_count() or 1) + io_workers)
+
+        def upload(index, file_path, plan):
+            try:
+                results[index] = self.upload_planned(file_path, plan.result(), replace)
+            except Exception as error:
+                results[index] = {"path": file_path, "name": os.path.basename(file_path), "status": "failed", "error": str(error)}
+            finally:
+                in_flight.release()
+
+        with concurrent.futures.ProcessPoolExecutor(workers) as processes, concurrent.futures.ThreadPoolExecutor(io_workers) as threads:
+            for index, file_path in enumerate(file_paths):
+                in_flight.acquire()
+                stat = self.server.stat_file(os.path.basename(file_path))
+                threads.submit(upload, index, file_path, processes.submit(plan_chunks, file_path, stat and stat["sha256"]))
+        return results
+
+    def upload_planned(self, file_path, plan, replace):
+        # Upload one file whose hash and chunk boundaries were computed by plan_chunks
+        file_name = os.path.basename(file_path)
+        result = {"path": file_path, "name": file_name, "status": "uploaded", "error": None}
+        stat = self.server.stat_file(file_name)
+        if stat is not None:
+            if stat["sha256"] == plan["sha256"]:
+                result["status"] = "skipped"
+                return result
+            if not replace:
+                result["status"] = "exists"
+                return result
+            self.server.create_version(file_name)
+            result["status"] = "replaced"
+        with open(file_path, "rb") as file:
+            # Replace only the content that was versioned, so a concurrent change is never overwritten unseen
+            if not self.server.upload_file(file_name, file, chunk_sizes=plan["chunk_sizes"], if_match=stat and stat["sha256"]):
+                result["status"] = "conflict" if stat else "exists"
+        return result
+
+    def download_many(self, file_names, destination_folder, workers=None, io_workers=BATCH_IO_WORKERS):
+        # Download many files and return one result per name, in order; local files that already match are skipped
+        def download(file_name, processes):
+            result = {"name": file_name, "path": os.path.join(destination_folder, file_name), "status": "downloaded", "error": None}
+            try:
+                stat = self.server.stat_file(file_name)
+                if stat is None:
+                    result["status"] = "not found"
+                elif os.path.exists(result["path"]) and processes.submit(hash_path, result["path"]).result() == stat["sha256"]:
+                    result["status"] = "skipped"
+                elif self.fetch_file(file_name, destination_folder, stat, streams=1) is None:
+                    result["status"] = "failed"
+                    result["error"] = "failed verification"
+            except Exception as error:
+                result["status"] = "failed"
+                result["error"] = str(error)
+            return result
+
+        # Created up front, so no download ever stops to ask for a folder
+        os.makedirs(destination_folder, exist_ok=True)
+        with concurrent.futures.ProcessPoolExecutor(workers) as processes, concurrent.futures.ThreadPoolExecutor(io_workers) as threads:
+            return list(threads.map(lambda file_name: download(file_name, processes), file_names))
+
+    def sync_directory(self, folder, workers=None):
+        # Upload every file in a folder, versioning and replacing files that changed
+        file_paths = sorted(entry.path for entry in os.scandir(folder) if entry.is_file())
+        return self.upload_many(file_paths, replace=True, workers=workers)
+
+    def list_files(self, prefix="", limit=None, after=None):
+        # List files available on the server
+        return self.server.list_files(prefix, limit, after)
 
     def create_version(self, file_name):
         # Create a version of the file
         return self.server.create_version(file_name)
 
+    def list_versions(self, file_name):
+        # List the versions of a file, oldest first
+        return self.server.list_versions(file_name)
+
+    def get_version(self, file_name, version_id, destination_folder):
+        # Save a version of a file into the destination folder
+        chunks = self.server.get_version(file_name, version_id)
+        if chunks is None:
+            print(f"Version '{version_id}' of '{file_name}' not found on the server.")
+            return None
+        file_path = os.path.join(destination_folder, file_name)
+        with open(file_path, "wb") as file:
+            for chunk in chunks:
+                file.write(chunk)
+        return file_path
+
     def remove_file(self, file_name):
         # Remove a file from the server
         return self.server.remove_file(file_name)
 
 
+async def read_frame(reader):
+    # Read one body frame; an empty frame marks the end of the body
+    (length,) = BODY_FRAME.unpack(await reader.readexactly(BODY_FRAME.size))
+    return await reader.readexactly(length) if length else b""
+
+
+async def write_frame(writer, data):
+    writer.write(BODY_FRAME.pack(len(data)))
+    if data:
+        writer.write(data)
+    # Waiting for the buffer to drain keeps a slow peer from growing our memory
+    await writer.drain()
+
+
+class StreamBody:
+    def __init__(self, reader, loop):
+        # Blocking file-like view over a framed body, read from a worker thread while the event loop does the I/O
+        self.reader = reader
+        self.loop = loop
+        self.buffer = bytearray()
+        self.done = False
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            frame = asyncio.run_coroutine_threadsafe(read_frame(self.reader), self.loop).result()
+            if frame:
+                self.buffer += frame
+            else:
+                self.done = True
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    async def drain(self):
+        # Consume whatever the handler didn't read so the next request starts on a frame boundary
+        while not self.done:
+            if not await read_frame(self.reader):
+                self.done = True
+
+
+class NetworkServer:
+    def __init__(self, server, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        # Serve a FileSharingServer over TCP; connections are coroutines, and blocking storage work runs on the default executor
+        self.server = server
+        self.host = host
+        self.port = port
+        self.listener = None
+
+    async def start(self):
+        self.listener = await asyncio.start_server(self.handle_connection, self.host, self.port)
+        self.port = self.listener.sockets[0].getsockname()[1]
+        return self.listener
+
+    async def serve_forever(self):
+        if self.listener is None:
+            await self.start()
+        async with self.listener:
+            await self.listener.serve_forever()
+
+    async def close(self):
+        self.listener.close()
+        await self.listener.wait_closed()
+
+    async def handle_connection(self, reader, writer):
+        # Handle requests on one connection until the client disconnects
+        try:
+            while True:
+                try:
+                    opcode, name_length, offset, length = REQUEST_HEADER.unpack(await reader.readexactly(REQUEST_HEADER.size))
+                except asyncio.IncompleteReadError:
+                    break
+                file_name = (await reader.readexactly(name_length)).decode()
+                await self.handle_request(opcode, file_name, reader, writer, offset, length)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, opcode, file_name, reader, writer, offset=0, length=0):
+        loop = asyncio.get_running_loop()
+        body = StreamBody(reader, loop) if opcode in (OP_UPLOAD, OP_REPLACE) else None
+        try:
+            if opcode == OP_GET_VERSION:
+                # The file name field carries the file name and version id
+                request = json.loads(file_name)
+                file_name, version_id = request["name"], request["version_id"]
+            elif opcode == OP_REPLACE:
+                # The file name field carries the file name and the SHA256 the file must still have
+                request = json.loads(file_name)
+                file_name, if_match = request["name"], request["if_match"]
+            if opcode != OP_LIST:
+                check_file_name(file_name)
+            if opcode == OP_UPLOAD:
+                result = await loop.run_in_executor(None, self.server.upload_file, file_name, body)
+                await body.drain()
+                status = STATUS_OK if result else STATUS_EXISTS
+            elif opcode == OP_REPLACE:
+                result = await loop.run_in_executor(None, functools.partial(self.server.upload_file, file_name, body, if_match=if_match))
+                await body.drain()
+                status = STATUS_OK if result else STATUS_CONFLICT
+            elif opcode in (OP_DOWNLOAD, OP_READ_RANGE, OP_GET_VERSION):
+                if opcode == OP_DOWNLOAD:
+                    chunks = await loop.run_in_executor(None, self.server.iter_download_file, file_name)
+                elif opcode == OP_GET_VERSION:
+                    chunks = await loop.run_in_executor(None, self.server.get_version, file_name, version_id)
+                else:
+                    chunks = await loop.run_in_executor(None, self.server.iter_range, file_name, offset, length)
+                if chunks is None:
+                    await self.respond(writer, STATUS_NOT_FOUND)
+                    return
+                writer.write(RESPONSE_HEADER.pack(STATUS_OK))
+                try:
+                    while True:
+                        chunk = await loop.run_in_executor(None, next, chunks, None)
+                        if chunk is None:
+                            break
+                        if chunk:
+                            # An empty frame would end the body early
+                            await write_frame(writer, chunk)
+                except Exception as error:
+                    # The OK status is already on the wire, so the error can't be sent in its place;
+                    # dropping the connection shows the client a truncated stream instead of a desynced one
+                    writer.transport.abort()
+                    raise ConnectionAbortedError(f"Stream of '{file_name}' failed: {error}") from error
+                finally:
+                    chunks.close()
+                await write_frame(writer, b"")
+                return
+            elif opcode == OP_STAT:
+                stat = await loop.run_in_executor(None, self.server.stat_file, file_name)
+                if stat is None:
+                    await self.respond(writer, STATUS_NOT_FOUND)
+                else:
+                    await self.respond(writer, STATUS_OK, json.dumps(stat).encode())
+                return
+            elif opcode == OP_LIST:
+                # The file name field carries the listing options
+                options = json.loads(file_name or "{}")
+                files = await loop.run_in_executor(None, self.server.list_files, options.get("prefix", ""), options.get("limit"), options.get("after"))
+                await self.respond(writer, STATUS_OK, json.dumps(files).encode())
+                return
+            elif opcode == OP_LIST_VERSIONS:
+                versions = await loop.run_in_executor(None, self.server.list_versions, file_name)
+                await self.respond(writer, STATUS_OK, json.dumps(versions).encode())
+                return
+            elif opcode == OP_VERSION:
+                status = STATUS_OK if await loop.run_in_executor(None, self.server.create_version, file_name) else STATUS_NOT_FOUND
+            elif opcode == OP_REMOVE:
+                status = STATUS_OK if await loop.run_in_executor(None, self.server.remove_file, file_name) else STATUS_NOT_FOUND
+            else:
+                raise ValueError(f"Unknown opcode {opcode}.")
+        except (ConnectionError, asyncio.IncompleteReadError):
+            raise
+        except Exception as error:
+            if body is not None:
+                await body.drain()
+            await self.respond(writer, STATUS_ERROR, str(error).encode())
+            return
+        await self.respond(writer, status)
+
+    async def respond(self, writer, status, data=b""):
+        writer.write(RESPONSE_HEADER.pack(status))
+        for chunk in iter_chunks(data):
+            await write_frame(writer, chunk)
+        await write_frame(writer, b"")
+
+
+class StorageNode(NetworkServer):
+    def __init__(self, folder=NODE_BLOCKS_FOLDER, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        # Stores opaque encrypted blocks for a cluster coordinator; it never sees keys or plaintext
+        super().__init__(None, host, port)
+        self.folder = folder
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+
+    def block_path(self, block_hash):
+        return os.path.join(self.folder, block_hash[:2], block_hash)
+
+    def write_block(self, block_hash, blob):
+        # Write through a synced temporary file so readers and crashes never see a partial block
+        block_path = self.block_path(block_hash)
+        os.makedirs(os.path.dirname(block_path), exist_ok=True)
+        atomic_write(block_path, [blob])
+
+    def read_block(self, block_hash):
+        if not os.path.exists(self.block_path(block_hash)):
+            return None
+        with open(self.block_path(block_hash), "rb") as file:
+            return file.read()
+
+    def delete_block(self, block_hash):
+        if os.path.exists(self.block_path(block_hash)):
+            os.remove(self.block_path(block_hash))
+
+    async def handle_request(self, opcode, block_hash, reader, writer, offset=0, length=0):
+        loop = asyncio.get_running_loop()
+        try:
+            if opcode == OP_PING:
+                await self.respond(writer, STATUS_OK)
+                return
+            if len(block_hash) != 64 or any(c not in "0123456789abcdef" for c in block_hash):
+                raise ValueError(f"Invalid block hash '{block_hash}'.")
+            if opcode == OP_PUT_BLOCK:
+                blob = bytearray()
+                while True:
+                    frame = await read_frame(reader)
+                    if not frame:
+                        break
+                    blob += frame
+                await loop.run_in_executor(None, self.write_block, block_hash, bytes(blob))
+                await self.respond(writer, STATUS_OK)
+            elif opcode == OP_GET_BLOCK:
+                blob = await loop.run_in_executor(None, self.read_block, block_hash)
+                if blob is None:
+                    await self.respond(writer, STATUS_NOT_FOUND)
+                else:
+                    await self.respond(writer, STATUS_OK, blob)
+            elif opcode == OP_DELETE_BLOCK:
+                await loop.run_in_executor(None, self.delete_block, block_hash)
+                await self.respond(writer, STATUS_OK)
+            else:
+                raise ValueError(f"Unknown opcode {opcode}.")
+        except (ConnectionError, asyncio.IncompleteReadError):
+            raise
+        except Exception as error:
+            await self.respond(writer, STATUS_ERROR, str(error).encode())
+
+
+class AsyncFileSharingClient:
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT):
+        # Talk to a NetworkServer over one connection; requests on it are serialized
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+        self.lock = asyncio.Lock()
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port)
+        return self
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            await self.writer.wait_closed()
+            self.writer = None
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def send_request(self, opcode, file_name="", offset=0, length=0):
+        name = file_name.encode()
+        self.writer.write(REQUEST_HEADER.pack(opcode, len(name), offset, length) + name)
+
+    async def read_response(self):
+        (status,) = RESPONSE_HEADER.unpack(await self.reader.readexactly(RESPONSE_HEADER.size))
+        return status
+
+    async def read_body(self):
+        # Read a whole (small) response body
+        data = bytearray()
+        while True:
+            frame = await read_frame(self.reader)
+            if not frame:
+                return bytes(data)
+            data += frame
+
+    async def simple_request(self, opcode, file_name=""):
+        async with self.lock:
+            await self.send_request(opcode, file_name)
+            status = await self.read_response()
+            body = await self.read_body()
+        if status == STATUS_ERROR:
+            raise RuntimeError(body.decode())
+        return status, body
+
+    async def upload_file(self, file_path, if_match=None):
+        # Upload a file to the server, streaming it from disk; with if_match, replace the file only if its SHA256 still matches
+        if not os.path.exists(file_path):
+            print(f"File '{file_path}' not found.")
+            return None
+        file_name = os.path.basename(file_path)
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            if if_match is None:
+                await self.send_request(OP_UPLOAD, file_name)
+            else:
+                await self.send_request(OP_REPLACE, json.dumps({"name": file_name, "if_match": if_match}))
+            with open(file_path, "rb") as file:
+                while True:
+                    chunk = await loop.run_in_executor(None, file.read, STREAM_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    await write_frame(self.writer, chunk)
+            await write_frame(self.writer, b"")
+            status = await self.read_response()
+            body = await self.read_body()
+        if status == STATUS_ERROR:
+            raise RuntimeError(body.decode())
+        if status == STATUS_EXISTS:
+            print("File upload failed: File already exists on the server.")
+            return None
+        if status == STATUS_CONFLICT:
+            print("File upload failed: File changed on the server.")
+            return None
+        return file_name
+
+    async def download_file(self, file_name, destination_folder, streams=DOWNLOAD_STREAMS):
+        # Download a file in ranges over several connections, resuming an interrupted download
+        status, body = await self.simple_request(OP_STAT, file_name)
+        if status != STATUS_OK:
+            print(f"File '{file_name}' not found on the server.")
+            return None
+        stat = json.loads(body)
+        progress = DownloadProgress(os.path.join(destination_folder, file_name), stat["size"], stat["sha256"])
+        pieces = asyncio.Queue()
+        for piece in progress.pending:
+            pieces.put_nowait(piece)
+
+        async def fetch_ranges():
+            async with AsyncFileSharingClient(self.host, self.port) as client:
+                while not pieces.empty():
+                    await client.download_range(file_name, progress, *pieces.get_nowait())
+        try:
+            await asyncio.gather(*(fetch_ranges() for _ in range(min(streams, len(progress.pending)))))
+        finally:
+            progress.close()
+        file_path = await asyncio.get_running_loop().run_in_executor(None, progress.finish)
+        if file_path is None:
+            print(f"File '{file_name}' failed verification and was discarded.")
+        return file_path
+
+    async def download_range(self, file_name, progress, offset, length):
+        # Fetch one range into the partial file
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            await self.send_request(OP_READ_RANGE, file_name, offset, length)
+            status = await self.read_response()
+            if status != STATUS_OK:
+                raise RuntimeError((await self.read_body()).decode() or f"File '{file_name}' not found on the server.")
+            position = offset
+            while True:
+                frame = await read_frame(self.reader)
+                if not frame:
+                    break
+                await loop.run_in_executor(None, progress.write, position, frame)
+                position += len(frame)
+        if position - offset != length:
+            raise IOError(f"Range at {offset} of '{file_name}' ended early.")
+        await loop.run_in_executor(None, progress.complete, offset)
+
+    async def download_whole_file(self, file_name, destination_folder):
+        # Download a file from the server over a single stream
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            await self.send_request(OP_DOWNLOAD, file_name)
+            status = await self.read_response()
+            if status != STATUS_OK:
+                body = await self.read_body()
+                if status == STATUS_ERROR:
+                    raise RuntimeError(body.decode())
+                print(f"File '{file_name}' not found on the server.")
+                return None
+            file_path = os.path.join(destination_folder, file_name)
+            with open(file_path, "wb") as file:
+                while True:
+                    frame = await read_frame(self.reader)
+                    if not frame:
+                        break
+                    await loop.run_in_executor(None, file.write, frame)
+        return file_path
+
+    async def stat_file(self, file_name):
+        # Return the size and SHA256 of a file, or None if it doesn't exist
+        status, body = await self.simple_request(OP_STAT, file_name)
+        return json.loads(body) if status == STATUS_OK else None
+
+    async def list_files(self, prefix="", limit=None, after=None):
+        # List files available on the server
+        _, body = await self.simple_request(OP_LIST, json.dumps({"prefix": prefix, "limit": limit, "after": after}))
+        return json.loads(body)
+
+    async def create_version(self, file_name):
+        # Create a version of the file
+        status, _ = await self.simple_request(OP_VERSION, file_name)
+        return status == STATUS_OK
+
+    async def remove_file(self, file_name):
+        # Remove a file from the server
+        status, _ = await self.simple_request(OP_REMOVE, file_name)
+        return status == STATUS_OK
+
+    async def list_versions(self, file_name):
+        # List the versions of a file, oldest first
+        _, body = await self.simple_request(OP_LIST_VERSIONS, file_name)
+        return json.loads(body)
+
+    async def get_version(self, file_name, version_id, destination_folder):
+        # Save a version of a file into the destination folder
+        loop = asyncio.get_running_loop()
+        async with self.lock:
+            await self.send_request(OP_GET_VERSION, json.dumps({"name": file_name, "version_id": version_id}))
+            status = await self.read_response()
+            if status != STATUS_OK:
+                body = await self.read_body()
+                if status == STATUS_ERROR:
+                    raise RuntimeError(body.decode())
+                print(f"Version '{version_id}' of '{file_name}' not found on the server.")
+                return None
+            file_path = os.path.join(destination_folder, file_name)
+            with open(file_path, "wb") as file:
+                while True:
+                    frame = await read_frame(self.reader)
+                    if not frame:
+                        break
+                    await loop.run_in_executor(None, file.write, frame)
+        return file_path
+
+
 def get_user_choice():
     # Get user's choice for actions
     while True:
-        choice = input("Enter 'U' to upload a file, 'D' to download a file, 'L' to list files, 'E' to view encrypted file, 'R' to remove a file, or 'Q' to quit: ").strip().upper()
-        if choice in ('U', 'D', 'L', 'E', 'R', 'Q'):
+        choice = input("Enter 'U' to upload a file, 'D' to download a file, 'L' to list files, 'E' to view encrypted file, 'V' to manage versions, 'R' to remove a file, or 'Q' to quit: ").strip().upper()
+        if choice in ('U', 'D', 'L', 'E', 'V', 'R', 'Q'):
             return choice
         else:
-            print("Invalid choice. Please enter 'U', 'D', 'L', 'E', 'R', or 'Q'.")
+            print("Invalid choice. Please enter 'U', 'D', 'L', 'E', 'V', 'R', or 'Q'.")
 
 
 if __name__ == "__main__":
-    # Initialize server and client
-    server = FileSharingServer()
+    if len(sys.argv) > 1 and sys.argv[1] == "serve":
+        # Serve files over the network: python code.py serve [host] [port] [node_host:port,...]
+        host = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_HOST
+        port = int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_PORT
+        cluster_nodes = sys.argv[4].split(",") if len(sys.argv) > 4 else None
+        print(f"Serving on {host}:{port}")
+        server = FileSharingServer(cluster_nodes, metrics=metrics_from_environment())
+        try:
+            asyncio.run(NetworkServer(server, host, port).serve_forever())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.close()
+        sys.exit()
+    if len(sys.argv) > 1 and sys.argv[1] == "node":
+        # Run a cluster storage node: python code.py node [host] [port] [folder]
+        host = sys.argv[2] if len(sys.argv) > 2 else DEFAULT_HOST
+        port = int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_PORT
+        folder = sys.argv[4] if len(sys.argv) > 4 else NODE_BLOCKS_FOLDER
+        print(f"Storage node on {host}:{port} storing blocks in '{folder}'")
+        asyncio.run(StorageNode(folder, host, port).serve_forever())
+        sys.exit()
+    if len(sys.argv) > 1 and sys.argv[1] == "reindex":
+        # Rebuild the metadata index from existing manifests/, versions/ and unmigrated uploads/ folders
+        server = FileSharingServer()
+        file_count, version_count = server.rebuild_index()
+        server.close()
+        print(f"Indexed {file_count} files and {version_count} versions.")
+        sys.exit()
+    if len(sys.argv) > 1 and sys.argv[1] == "rotate-key":
+        # Replace the master key; only the wrapped data keys are rewritten
+        server = FileSharingServer()
+        print(f"Rotated the master key and rewrapped {server.rotate_master_key()} data keys.")
+        server.close()
+        sys.exit()
+    if len(sys.argv) > 1 and sys.argv[1] == "migrate":
+        # Encrypt plaintext copies left in uploads/ by earlier releases and delete them
+        server = FileSharingServer()
+        print(f"Migrated {server.migrate_uploads()} files to encrypted-only storage.")
+        server.close()
+        sys.exit()
+
+    if len(sys.argv) > 2 and sys.argv[1] == "sync":
+        # Upload a folder without prompting: python code.py sync folder
+        server = FileSharingServer()
+        results = FileSharingClient(server).sync_directory(sys.argv[2])
+        server.close()
+        for result in results:
+            print(f"{result['status']:>9}  {result['name']}" + (f"  ({result['error']})" if result["error"] else ""))
+        print(f"{len(results)} files, {sum(result['status'] in ('uploaded', 'replaced') for result in results)} uploaded.")
+        sys.exit()
+
+    # Initialize server and client; python code.py cluster node_host:port,... stores blocks on storage nodes
+    server = FileSharingServer(sys.argv[2].split(",") if len(sys.argv) > 2 and sys.argv[1] == "cluster" else None, metrics=metrics_from_environment())
     client = FileSharingClient(server)
 
     while True:
@@ -187,7 +2841,7 @@ if __name__ == "__main__":
 
         elif user_choice == 'D':
             # Download a file
-            print("Files on server:", client.list_files())
+            print("Files on server:", client.list_files(limit=LIST_PAGE_SIZE))
             file_name = input("Enter the file name to download: ")
             destination_folder = input("Enter the destination folder path to save the downloaded file: ")
             downloaded_file_path = client.download_file(file_name, destination_folder)
@@ -197,24 +2851,51 @@ if __name__ == "__main__":
                 print(f"File '{file_name}' not found on the server.")
 
         elif user_choice == 'L':
-            # List all files on the server
-            print("Files on server:", client.list_files())
+            # List files on the server a page at a time
+            prefix = input("Enter a name prefix to filter by (leave empty for all files): ")
+            after = None
+            while True:
+                files = client.list_files(prefix, LIST_PAGE_SIZE, after)
+                print("Files on server:", files)
+                if len(files) < LIST_PAGE_SIZE or input("Show more? (yes/no): ").strip().lower() != 'yes':
+                    break
+                after = files[-1]
 
         elif user_choice == 'E':
             # View encrypted file data
-            print("Files on server:", client.list_files())
+            print("Files on server:", client.list_files(limit=LIST_PAGE_SIZE))
             file_name = input("Enter the file name to view encrypted: ")
-            encrypted_file_path = os.path.join(ENCRYPTED_FOLDER, file_name)
-            if os.path.exists(encrypted_file_path):
-                with open(encrypted_file_path, "rb") as file:
-                    encrypted_data = file.read()
+            if server.index.get(file_name) is not None:
+                encrypted_data = b"".join(server.iter_encrypted(file_name))
                 print(f"Encrypted data: {encrypted_data}")
             else:
                 print(f"File '{file_name}' not found on the server.")
 
+        elif user_choice == 'V':
+            # Create, list or download versions of a file
+            print("Files on server:", client.list_files(limit=LIST_PAGE_SIZE))
+            file_name = input("Enter the file name: ")
+            action = input("Enter 'C' to create a version, 'L' to list versions, or 'D' to download a version: ").strip().upper()
+            if action == 'C':
+                if client.create_version(file_name):
+                    print(f"Version of '{file_name}' created successfully.")
+                else:
+                    print(f"File '{file_name}' not found on the server or this version already exists.")
+            elif action == 'L':
+                for version in client.list_versions(file_name):
+                    print(f"{version['version_id']}  {time.ctime(version['created'])}  {version['size']} bytes")
+            elif action == 'D':
+                version_id = input("Enter the version id to download: ").strip()
+                destination_folder = input("Enter the destination folder path to save the version: ")
+                version_path = client.get_version(file_name, version_id, destination_folder)
+                if version_path:
+                    print(f"Version downloaded successfully and saved to: {version_path}")
+            else:
+                print("Invalid choice.")
+
         elif user_choice == 'R':
             # Remove a file from the server
-            print("Files on server:", client.list_files())
+            print("Files on server:", client.list_files(limit=LIST_PAGE_SIZE))
             file_name = input("Enter the file name to remove from the server: ")
             if client.remove_file(file_name):
                 print(f"File '{file_name}' removed successfully from the server.")
@@ -224,4 +2905,5 @@ if __name__ == "__main__":
         elif user_choice == 'Q':
             # Quit the program
             print("Exiting...")
+            server.close()
             break
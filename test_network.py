@@ -0,0 +1,242 @@
+import os
+import sys
+import time
+import shutil
+import hashlib
+import socket
+import asyncio
+import tempfile
+import unittest
+import subprocess
+
+from code import FileSharingServer, FileSharingClient, NetworkServer, AsyncFileSharingClient, OP_READ_RANGE, STATUS_OK
+
+CODE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "code.py")
+
+
+class LoopbackTest(unittest.IsolatedAsyncioTestCase):
+    # A NetworkServer and client talking over 127.0.0.1 in a scratch storage folder
+
+    async def asyncSetUp(self):
+        self.previous_folder = os.getcwd()
+        self.folder = tempfile.mkdtemp(prefix="fss-test-")
+        os.chdir(self.folder)
+        # No read cache, so every download decrypts the stored blocks
+        self.server = FileSharingServer(cache_size=0)
+        self.network = NetworkServer(self.server, "127.0.0.1", 0)
+        await self.network.start()
+        self.client = await AsyncFileSharingClient("127.0.0.1", self.network.port).connect()
+        self.data = os.urandom(3 * 1024 * 1024)
+        with open("source.bin", "wb") as file:
+            file.write(self.data)
+        os.makedirs("out")
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.network.close()
+        self.server.close()
+        os.chdir(self.previous_folder)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    async def read_range(self, client, file_name, offset, length):
+        async with client.lock:
+            await client.send_request(OP_READ_RANGE, file_name, offset, length)
+            status = await client.read_response()
+            return status, await client.read_body()
+
+    async def test_upload_and_download(self):
+        self.assertEqual(await self.client.upload_file("source.bin"), "source.bin")
+        path = await self.client.download_whole_file("source.bin", "out")
+        with open(path, "rb") as file:
+            self.assertEqual(file.read(), self.data)
+        # The ranged, resumable download checks the server's SHA256 before keeping the file
+        os.remove(path)
+        path = await self.client.download_file("source.bin", "out")
+        with open(path, "rb") as file:
+            self.assertEqual(file.read(), self.data)
+
+    async def test_read_range(self):
+        await self.client.upload_file("source.bin")
+        status, body = await self.read_range(self.client, "source.bin", 1000000, 1500000)
+        self.assertEqual(status, STATUS_OK)
+        self.assertEqual(body, self.data[1000000:2500000])
+        status, body = await self.read_range(self.client, "source.bin", len(self.data) - 10, 100)
+        self.assertEqual(body, self.data[-10:])
+        # An empty range yields no chunks at all, so no empty frame reaches the stream
+        self.assertEqual(list(self.server.iter_range("source.bin", 1000, 0)), [])
+
+    async def test_conditional_replace(self):
+        await self.client.upload_file("source.bin")
+        self.assertIsNone(await self.client.upload_file("source.bin", if_match="0" * 64))
+        stat = await self.client.stat_file("source.bin")
+        self.assertEqual(await self.client.upload_file("source.bin", if_match=stat["sha256"]), "source.bin")
+
+    async def test_error_mid_stream_drops_connection(self):
+        await self.client.upload_file("source.bin")
+        # Corrupt a block after the first, so the failure comes after the OK status and some frames
+        manifest = self.server.load_manifest(self.server.manifest_path("source.bin"))
+        self.assertGreater(len(manifest["chunks"]), 2)
+        with open(self.server.blocks.block_path(manifest["chunks"][2][0]), "r+b") as file:
+            file.seek(100)
+            byte = file.read(1)
+            file.seek(100)
+            file.write(bytes([byte[0] ^ 1]))
+        with self.assertRaises((asyncio.IncompleteReadError, ConnectionError)):
+            await asyncio.wait_for(self.client.download_whole_file("source.bin", "out"), 10)
+        # Other connections are unaffected, and reads before the corrupt block still work
+        client = await AsyncFileSharingClient("127.0.0.1", self.network.port).connect()
+        try:
+            self.assertEqual(await asyncio.wait_for(client.list_files(), 10), ["source.bin"])
+            status, body = await self.read_range(client, "source.bin", 0, 1000)
+            self.assertEqual(body, self.data[:1000])
+        finally:
+            await client.close()
+
+    async def test_read_survives_remove(self):
+        await self.client.upload_file("source.bin")
+        # A download or range that has returned keeps the content it started with
+        chunks = self.server.iter_download_file("source.bin")
+        ranged = self.server.iter_range("source.bin", 1000, 2000000)
+        unread = self.server.iter_download_file("source.bin")
+        self.assertTrue(await self.client.remove_file("source.bin"))
+        self.assertEqual(b"".join(chunks), self.data)
+        self.assertEqual(b"".join(ranged), self.data[1000:2001000])
+        # Dropping a download that was never read releases its blocks
+        del unread
+        self.server.blocks.collect_garbage()
+        self.assertEqual(self.server.blocks.db.execute("SELECT COUNT(*) FROM blocks").fetchone()[0], 0)
+        self.assertIsNone(self.server.iter_download_file("source.bin"))
+        self.assertIsNone(self.server.iter_range("source.bin", 0, 10))
+        self.assertIsNone(self.server.iter_decrypt_file("source.bin"))
+
+    async def test_empty_chunks_keep_the_connection_in_sync(self):
+        # An empty file stored by an earlier release as a single Fernet token decrypts to one empty chunk
+        with open(os.path.join("encrypted", "empty"), "wb") as file:
+            file.write(self.server.cipher.encrypt(b""))
+        self.server.index.put("empty", 0, time.time(), hashlib.sha256(b"").hexdigest(), os.path.join("encrypted", "empty"))
+        path = await self.client.download_whole_file("empty", "out")
+        with open(path, "rb") as file:
+            self.assertEqual(file.read(), b"")
+        self.assertEqual(await self.client.list_files(), ["empty"])
+        await self.client.upload_file("source.bin")
+        status, body = await self.read_range(self.client, "source.bin", 10, 0)
+        self.assertEqual((status, body), (STATUS_OK, b""))
+        self.assertEqual((await self.client.stat_file("source.bin"))["size"], len(self.data))
+
+    async def test_invalid_names(self):
+        for name in (".", "..", "a/b", "a\0b"):
+            with self.assertRaises(ValueError):
+                self.server.upload_file(name, b"data")
+            with self.assertRaises(ValueError):
+                self.server.remove_file(name)
+            with self.assertRaises(ValueError):
+                self.server.iter_download_file(name)
+        # Over TCP the same names are refused with an error status, and the connection stays usable
+        for name in (".", ".."):
+            with self.assertRaises(RuntimeError):
+                await self.client.create_version(name)
+            with self.assertRaises(RuntimeError):
+                await self.client.remove_file(name)
+        self.assertEqual(await self.client.list_files(), [])
+        self.assertEqual(os.listdir("versions") if os.path.exists("versions") else [], [])
+
+    async def test_download_many_creates_the_folder(self):
+        await self.client.upload_file("source.bin")
+        # Any prompt would fail here, since pytest gives input() no stdin
+        results = FileSharingClient(self.server).download_many(["source.bin", "missing"], os.path.join("out", "new"), workers=1)
+        self.assertEqual([result["status"] for result in results], ["downloaded", "not found"])
+        with open(results[0]["path"], "rb") as file:
+            self.assertEqual(file.read(), self.data)
+
+    async def test_missing_file(self):
+        self.assertIsNone(await self.client.download_whole_file("missing", "out"))
+        self.assertEqual(await self.client.list_files(), [])
+
+
+class ClusterTest(unittest.TestCase):
+    # Storage nodes run as separate processes on 127.0.0.1; the coordinating server runs in the test
+
+    def setUp(self):
+        self.previous_folder = os.getcwd()
+        self.folder = tempfile.mkdtemp(prefix="fss-test-")
+        os.chdir(self.folder)
+        self.nodes = {}
+        self.server = None
+        self.files = {f"file_{i}": os.urandom(1024 * 1024) for i in range(4)}
+
+    def tearDown(self):
+        if self.server is not None:
+            self.server.close()
+        for process in self.nodes.values():
+            process.kill()
+            process.wait()
+        os.chdir(self.previous_folder)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def start_node(self, address=None):
+        if address is None:
+            with socket.socket() as probe:
+                probe.bind(("127.0.0.1", 0))
+                address = f"127.0.0.1:{probe.getsockname()[1]}"
+        port = address.rsplit(":", 1)[1]
+        self.nodes[address] = subprocess.Popen([sys.executable, CODE_PATH, "node", "127.0.0.1", port, f"node_{port}"], stdout=subprocess.DEVNULL)
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", int(port))).close()
+                return address
+            except ConnectionRefusedError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def kill_node(self, address):
+        self.nodes[address].kill()
+        self.nodes.pop(address).wait()
+
+    def upload_all(self):
+        for name, data in self.files.items():
+            self.assertEqual(self.server.upload_file(name, data), name)
+
+    def assert_readable(self):
+        for name, data in self.files.items():
+            self.assertEqual(self.server.download_file(name), data)
+
+    def test_join_kill_and_read(self):
+        first, second = self.start_node(), self.start_node()
+        self.server = FileSharingServer([first, second], cache_size=0)
+        self.upload_all()
+        third = self.start_node()
+        moved, failed = self.server.blocks.add_node(third)
+        self.assertGreater(moved, 0)
+        self.assertEqual(failed, [])
+        # Every block has a second replica, so losing any one node loses nothing
+        self.kill_node(first)
+        self.assert_readable()
+        moved, failed = self.server.blocks.remove_node(first)
+        self.assertEqual(failed, [])
+        self.assertNotIn(first, self.server.blocks.nodes)
+        # Re-replication put every block on both survivors
+        self.kill_node(second)
+        self.assert_readable()
+
+    def test_missed_replica_is_repaired(self):
+        first, second = self.start_node(), self.start_node()
+        self.server = FileSharingServer([first, second], cache_size=0, write_quorum=1)
+        self.kill_node(second)
+        self.upload_all()
+        self.assertTrue(self.server.blocks.db.execute("SELECT COUNT(*) FROM under_replicated").fetchone()[0])
+        # With every replica required, a node being down fails the upload instead of leaving one copy
+        self.server.blocks.write_quorum = 2
+        with self.assertRaises(IOError):
+            self.server.upload_file("strict", os.urandom(100000))
+        self.start_node(second)
+        moved, failed = self.server.blocks.repair()
+        self.assertEqual(failed, [])
+        self.assertEqual(self.server.blocks.db.execute("SELECT COUNT(*) FROM under_replicated").fetchone()[0], 0)
+        self.kill_node(first)
+        self.assert_readable()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,183 @@
+import os
+import sys
+import shutil
+import tempfile
+import hashlib
+import threading
+import unittest
+import subprocess
+
+from code import FileSharingServer, KEY_FILE, MANIFESTS_FOLDER, UPLOADS_FOLDER
+
+CODE_FOLDER = os.path.dirname(os.path.abspath(__file__))
+
+# Uploads one file, then stops in the middle of a second upload and waits to be killed
+CRASHING_SERVER = f"""
+import os, sys
+sys.path.insert(0, {CODE_FOLDER!r})
+from code import FileSharingServer
+server = FileSharingServer()
+server.upload_file("kept", bytes(range(256)) * 4096)
+server.journal.begin("upload", name="lost")
+manifest = server.store_blocks(os.urandom(1024 * 1024))
+server.write_manifest(server.manifest_path("lost"), manifest)
+print("ready", flush=True)
+sys.stdin.read()
+"""
+
+# Migrates the plaintext copy of "old.txt", but dies before the migration commits
+CRASHING_MIGRATION = f"""
+import sys
+sys.path.insert(0, {CODE_FOLDER!r})
+from code import FileSharingServer
+server = FileSharingServer()
+
+def stop(record_id):
+    print("ready", flush=True)
+    sys.stdin.read()
+
+server.commit = stop
+server.migrate_uploads()
+"""
+
+# Keeps a server open on the folder until killed
+OPEN_SERVER = f"""
+import sys
+sys.path.insert(0, {CODE_FOLDER!r})
+from code import FileSharingServer
+server = FileSharingServer()
+print("ready", flush=True)
+sys.stdin.read()
+"""
+
+
+class StorageTest(unittest.TestCase):
+    # Servers on a scratch storage folder, some of them in child processes
+
+    def setUp(self):
+        self.previous_folder = os.getcwd()
+        self.folder = tempfile.mkdtemp(prefix="fss-test-")
+        os.chdir(self.folder)
+
+    def tearDown(self):
+        os.chdir(self.previous_folder)
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def crash(self, script):
+        # Run script in a child process and kill it once it prints "ready"
+        child = subprocess.Popen([sys.executable, "-c", script], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        try:
+            self.assertEqual(child.stdout.readline().strip(), "ready")
+            # A second process must not take the live server's journal for a crash
+            with self.assertRaises(RuntimeError):
+                FileSharingServer()
+        finally:
+            child.kill()
+            child.wait()
+            child.stdout.close()
+            child.stdin.close()
+
+    def test_crash_and_recover(self):
+        self.crash(CRASHING_SERVER)
+        self.assertTrue(os.path.exists(os.path.join(MANIFESTS_FOLDER, "lost.manifest")))
+        server = FileSharingServer()
+        try:
+            self.assertEqual(server.list_files(), ["kept"])
+            self.assertEqual(server.download_file("kept"), bytes(range(256)) * 4096)
+            self.assertFalse(os.path.exists(os.path.join(MANIFESTS_FOLDER, "lost.manifest")))
+            # Only the blocks of the kept file survive, each referenced once
+            manifest = server.load_manifest(server.manifest_path("kept"))
+            refs = dict(server.blocks.db.execute("SELECT hash, refs FROM blocks"))
+            self.assertEqual(set(refs), {block_hash for block_hash, _ in manifest["chunks"]})
+        finally:
+            server.close()
+        # A clean close leaves nothing to recover and releases the folder
+        server = FileSharingServer()
+        self.assertEqual(server.journal.records, [])
+        server.close()
+
+    def test_interrupted_migration_keeps_the_plaintext_copy(self):
+        # A storage folder from a release that kept a plaintext copy of every file
+        data = os.urandom(300000)
+        server = FileSharingServer()
+        os.makedirs(UPLOADS_FOLDER)
+        path = os.path.join(UPLOADS_FOLDER, "old.txt")
+        with open(path, "wb") as file:
+            file.write(data)
+        server.index.put("old.txt", len(data), os.path.getmtime(path), hashlib.sha256(data).hexdigest(), path)
+        server.close()
+        self.crash(CRASHING_MIGRATION)
+        # Recovery goes back to the copy, which was never deleted
+        server = FileSharingServer()
+        try:
+            self.assertTrue(os.path.exists(path))
+            self.assertFalse(os.path.exists(server.manifest_path("old.txt")))
+            self.assertEqual(server.index.get("old.txt")["location"], path)
+            self.assertEqual(server.download_file("old.txt"), data)
+            self.assertEqual(server.migrate_uploads(), 1)
+            self.assertFalse(os.path.exists(UPLOADS_FOLDER))
+            self.assertEqual(server.download_file("old.txt"), data)
+        finally:
+            server.close()
+
+    def test_rotate_key_and_read_after_restart(self):
+        data, blob = os.urandom(500000), os.urandom(200000)
+        server = FileSharingServer()
+        server.upload_file("before", data)
+        server.encrypt_file("blob.enc", blob)
+        server.close()
+        with open(KEY_FILE, "rb") as file:
+            old_keys = file.read()
+        # Rotating next to a live server would leave it wrapping new keys under the retired one
+        child = subprocess.Popen([sys.executable, "-c", OPEN_SERVER], stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+        try:
+            self.assertEqual(child.stdout.readline().strip(), "ready")
+            rotation = subprocess.run([sys.executable, os.path.join(CODE_FOLDER, "code.py"), "rotate-key"], capture_output=True, text=True)
+            self.assertNotEqual(rotation.returncode, 0)
+            self.assertIn("in use by another process", rotation.stderr)
+        finally:
+            child.stdin.close()
+            child.wait()
+            child.stdout.close()
+        with open(KEY_FILE, "rb") as file:
+            self.assertEqual(file.read(), old_keys)
+        rotation = subprocess.run([sys.executable, os.path.join(CODE_FOLDER, "code.py"), "rotate-key"], capture_output=True, text=True)
+        self.assertEqual(rotation.returncode, 0, rotation.stderr)
+        with open(KEY_FILE, "rb") as file:
+            new_keys = file.read().split()
+        self.assertEqual(len(new_keys), 1)
+        self.assertNotIn(new_keys[0], old_keys.split())
+        server = FileSharingServer()
+        try:
+            server.upload_file("after", data[::-1])
+        finally:
+            server.close()
+        # Everything written before and after the rotation reads back under the new key alone
+        server = FileSharingServer()
+        try:
+            self.assertEqual(server.download_file("before"), data)
+            self.assertEqual(server.download_file("after"), data[::-1])
+            self.assertEqual(server.decrypt_file("blob.enc"), blob)
+        finally:
+            server.close()
+
+    def test_stats_do_not_wait_for_the_block_lock(self):
+        data = os.urandom(300000)
+        server = FileSharingServer()
+        try:
+            server.upload_file("a", data)
+            server.upload_file("b", data)
+            results = []
+            with server.blocks.lock:
+                # A scrape while a put or reference update holds the lock
+                thread = threading.Thread(target=lambda: results.append(server.blocks.stats()))
+                thread.start()
+                thread.join(5)
+            self.assertEqual(results[0]["logical_bytes"], 2 * len(data))
+            self.assertEqual(results[0]["unique_bytes"], len(data))
+        finally:
+            server.close()
+
+
+if __name__ == "__main__":
+    unittest.main()